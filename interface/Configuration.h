@@ -15,13 +15,20 @@
 // ----------------------------------------------------------------------------
 #include <string>
 #include <sstream>
+#include <map>
+#include <mutex>
+#include <atomic>
 
 namespace edm {
 class ParameterSet;
 }
 class HLTConfigProvider;
 
-/// A singleton class to cache global objects.
+/** A singleton class to cache global objects.
+    The singleton is created on first use (which is thread-safe). Pointers
+    are published atomically and the block information is guarded by a
+    mutex so that the configuration can be read safely from any thread.
+*/
 class Configuration
 {
 public:
@@ -35,19 +42,19 @@ public:
   ///
   void set(const edm::ParameterSet& config)
   { 
-    config_ = &config;
+    config_.store(&config);
   }
 
   ///
   void set(HLTConfigProvider& hltconfig) 
   { 
-    hltconfig_ = &hltconfig;
+    hltconfig_.store(&hltconfig);
   }
 
   ///
   void set(HLTConfigProvider* hltconfig) 
   { 
-    hltconfig_ = hltconfig;
+    hltconfig_.store(hltconfig);
   }
 
   ///
@@ -56,6 +63,7 @@ public:
            std::string& labelname,
            std::map<std::string, std::string>& parameters)
   { 
+    std::lock_guard<std::mutex> guard(mutex_);
     blockname_  = blockname;
     buffername_ = buffername;
     labelname_  = labelname;
@@ -63,32 +71,49 @@ public:
   }
 
   ///
-  const edm::ParameterSet* getConfig() const { return config_; }
+  const edm::ParameterSet* getConfig() const { return config_.load(); }
 
   ///
-  const HLTConfigProvider* getHLTconfig() const { return hltconfig_; }
+  const HLTConfigProvider* getHLTconfig() const { return hltconfig_.load(); }
 
   ///
-  std::string getBlockname() const { return blockname_; }
+  std::string getBlockname() const 
+  { 
+    std::lock_guard<std::mutex> guard(mutex_);
+    return blockname_; 
+  }
 
   ///
-  std::string getBuffername() const { return buffername_; }
+  std::string getBuffername() const 
+  { 
+    std::lock_guard<std::mutex> guard(mutex_);
+    return buffername_; 
+  }
 
   ///
-  std::string getLabelname() const { return labelname_; }
+  std::string getLabelname() const 
+  { 
+    std::lock_guard<std::mutex> guard(mutex_);
+    return labelname_; 
+  }
 
   ///
   std::map<std::string, std::string> 
-  getParameters() const { return parameters_; }
+  getParameters() const 
+  { 
+    std::lock_guard<std::mutex> guard(mutex_);
+    return parameters_; 
+  }
 
 private:
-  Configuration() {}                               // prevent explicit creation
+  Configuration() : config_(0), hltconfig_(0) {}  // prevent explicit creation
   ~Configuration() {}                  
   Configuration(const Configuration&);             // prevent copy
   Configuration& operator=(const Configuration&);  // prevent assignment
   
-  const edm::ParameterSet* config_;
-  const HLTConfigProvider* hltconfig_;
+  std::atomic<const edm::ParameterSet*> config_;
+  std::atomic<const HLTConfigProvider*> hltconfig_;
+  mutable std::mutex mutex_;
 
   std::string blockname_;
   std::string buffername_;
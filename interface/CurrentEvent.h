@@ -14,13 +14,18 @@
 #include <map>
 #include <vector>
 #include <string>
+#include <atomic>
 
 namespace edm {
 class Event;
 class EventSetup;
 }
 
-/// A singleton class to cache event.
+/** A singleton class to cache event.
+    The singleton is created on first use (which is thread-safe) and the 
+    event and event setup are published atomically so that the current
+    event can be read safely from any thread.
+*/
 class CurrentEvent
 {
 public:
@@ -34,24 +39,30 @@ public:
   ///
   void set(const edm::Event& event, const edm::EventSetup& setup) 
   { 
-    event_ = &event;
-    setup_ = &setup;
+    setup_.store(&setup);
+    event_.store(&event);
+    count_++;
   }
 
   ///
-  const edm::Event* get() const { return event_; }
+  const edm::Event* get() const { return event_.load(); }
 
   ///
-  const edm::EventSetup* getsetup() const { return setup_; }
+  const edm::EventSetup* getsetup() const { return setup_.load(); }
+
+  /// Serial number of current event (the number of events set so far).
+  unsigned long count() const { return count_.load(); }
 
 private:
-  CurrentEvent() {}        // prevent explicit creation
+  CurrentEvent() 
+    : event_(0), setup_(0), count_(0) {}        // prevent explicit creation
   ~CurrentEvent() {}                  
   CurrentEvent(const CurrentEvent&);             // prevent copy
   CurrentEvent& operator=(const CurrentEvent&);  // prevent assignment
   
-  const edm::Event* event_;
-  const edm::EventSetup* setup_;
+  std::atomic<const edm::Event*> event_;
+  std::atomic<const edm::EventSetup*> setup_;
+  std::atomic<unsigned long> count_;
 };
 
 #endif
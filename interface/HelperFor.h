@@ -12,6 +12,8 @@
 //-----------------------------------------------------------------------------
 #include <sstream>
 #include <memory>
+#include <map>
+#include <set>
 #include "PhysicsTools/TheNtupleMaker/interface/Configuration.h"
 #include "PhysicsTools/TheNtupleMaker/interface/CurrentEvent.h"
 //-----------------------------------------------------------------------------
@@ -42,7 +44,8 @@ public:
                 object(0),     // pointer to current helped object
                 oindex(0),     // index of current helped object (dumb pointer)
                 index(0),      // index of current helper object (dumb pointer)
-                count(1)       // number of instances returned by helper
+                count(1),      // number of instances returned by helper
+                eventcount(0)  // serial number of event of cached results
 
   {}
 
@@ -62,6 +65,49 @@ public:
     object = &o; 
     oindex = n; 
     count  = 1; 
+
+    // forget the object-level results of a previous event
+    unsigned long serial = CurrentEvent::instance().count();
+    if ( serial != eventcount )
+      {
+        clearObjectCache();
+        eventcount = serial;
+      }
+  }
+
+  /// Call analyzeObject for the current object, unless it has already 
+  /// been called for this object in the current event. Use this, rather 
+  /// than analyzeObject, when the helper methods of an object are called 
+  /// in several passes, e.g., one per variable. Objects are identified by
+  /// their address, so the index passed to cacheObject does not matter.
+  void analyzeObjectOnce()
+  {
+    if ( analyzed.insert(object).second ) analyzeObject();
+  }
+
+  /// Cache a result of analyzeObject for the current object.
+  void setResult(std::string name, double value) 
+  { 
+    results[object][name] = value; 
+  }
+
+  /// Return a cached result for the current object (zero if none).
+  double result(std::string name) const
+  {
+    typename std::map<const X*, 
+                      std::map<std::string, double> >::const_iterator
+      it = results.find(object);
+    if ( it == results.end() ) return 0;
+    std::map<std::string, double>::const_iterator r = it->second.find(name);
+    if ( r == it->second.end() ) return 0;
+    return r->second;
+  }
+
+  /// Forget the object-level results (see analyzeObjectOnce).
+  void clearObjectCache()
+  {
+    analyzed.clear();
+    results.clear();
   }
 
   /// return number of items per cached object
@@ -78,8 +124,9 @@ public:
   /// do some object-level analysis, if needed.
   virtual void analyzeObject() {}
 
-  /// do some post event-level analysis, if needed.
-  virtual void flushEvent() {}
+  /// do some post event-level analysis, if needed. A helper that
+  /// overrides this method should call HelperFor<X>::flushEvent().
+  virtual void flushEvent() { clearObjectCache(); }
 
   // ---------------- available to user
   
@@ -138,6 +185,16 @@ public:
 
   /// 
   int count;
+
+private:
+  /// Serial number of the event whose object-level results are cached.
+  unsigned long eventcount;
+
+  /// Objects analyzed in the current event.
+  std::set<const X*> analyzed;
+
+  /// Results of analyzeObject, by object.
+  std::map<const X*, std::map<std::string, double> > results;
 };
 
 
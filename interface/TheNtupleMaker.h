@@ -39,16 +39,19 @@
 #include <boost/algorithm/string.hpp>
 #include <vector>
 #include <string>
+#include <algorithm>
+#include <type_traits>
 #include <iostream>
 #include <fstream>
 #include <stdlib.h>
 
-#include "FWCore/Framework/interface/EDAnalyzer.h"
+#include "FWCore/Framework/interface/one/EDAnalyzer.h"
 #include "FWCore/Framework/interface/Event.h"
 #include "FWCore/Framework/interface/Frameworkfwd.h"
 
 #include "FWCore/ParameterSet/interface/ParameterSet.h"
 #include "DataFormats/Common/interface/Handle.h"
+#include "DataFormats/Common/interface/TriggerResults.h"
 #include "FWCore/Framework/interface/MakerMacros.h"
 
 #include "PhysicsTools/TheNtupleMaker/interface/colors.h"
@@ -67,15 +70,24 @@ namespace {
 };
 class VariableDescriptor;
 // ----------------------------------------------------------------------------
-class TheNtupleMaker : public edm::EDAnalyzer 
+// TheNtupleMaker fills a single tree through buffers compiled by the JIT,
+// so it is a "one" module: the framework calls it for one event at a time
+// but other modules can run concurrently.
+class TheNtupleMaker : 
+  public edm::one::EDAnalyzer<edm::one::WatchRuns,
+			      edm::one::SharedResources,
+			      edm::WatchInputFiles>
 {
 public:
   explicit TheNtupleMaker(const edm::ParameterSet&);
   virtual ~TheNtupleMaker();
-  virtual void beginJob();
-  virtual void beginRun(const edm::Run&, const edm::EventSetup&);
-  virtual void analyze(const edm::Event&, const edm::EventSetup&);
-  virtual void endJob();
+  void beginJob() override;
+  void beginRun(const edm::Run&, const edm::EventSetup&) override;
+  void endRun(const edm::Run&, const edm::EventSetup&) override;
+  void analyze(const edm::Event&, const edm::EventSetup&) override;
+  void endJob() override;
+  void respondToOpenInputFile(const edm::FileBlock&) override;
+  void respondToCloseInputFile(const edm::FileBlock&) override;
 
   template <typename T>
   edm::EDGetTokenT<T> getToken(std::string label)
@@ -92,10 +104,19 @@ public:
     return consumes<T>(edm::InputTag(label1, label2));
   }
 
+  template <typename T>
+  edm::EDGetTokenT<T> getToken(const edm::InputTag& tag)
+  {
+    return consumes<T>(tag);
+  }
+
   TTree* getTree();
   
 private:
   bool selectEvent(const edm::Event& iEvent);
+  void compileBuffers(std::ofstream& fout);
+  void declareBuffers(std::ofstream& fout);
+  void configureBranches(const edm::ParameterSet& iConfig);
   void updateTriggerBranches(int blockindex);
   void createBranchnames(std::string blockName,  
 			 std::string prefix,
@@ -116,7 +137,29 @@ struct VariableThing
   virtual ~VariableThing() {};
   virtual void init(TTree* tree)=0;
   virtual void get(const void* address)=0;
+  virtual void* valueAddress()=0;
+  virtual void truncate()=0;
+  virtual size_t size()=0;
+  virtual double number()=0;
+  virtual void flush(int n)=0;
+  virtual void clear()=0;
+  virtual void compile()=0;
+  virtual void useNative(bool yes)=0;
+  virtual bool isNative()=0;
+  virtual void bind(std::string classname, 
+		    long unsigned int address,
+		    long unsigned int function)=0;
   static int count;
+
+  std::string branchname;          /// name of branch associated with method
+  std::string otype;               /// object type (could also be a simple type)
+  std::string rtype;               /// return type of method
+  std::string method;              /// method
+  int         maxcount;            /// maximum count/variable  
+  int         bits;                /// if > 0, mantissa bits of stored floats
+  bool        packed;              /// if true, bool packed into flags branch
+  std::string counter;             /// if set, name of counter of array branch
+  bool        flatten;             /// if true, flatten nested vectors
 };
 int VariableThing::count = 0;
 
@@ -128,7 +171,23 @@ struct BufferThing
   virtual ~BufferThing() {}
   virtual void add(VariableThing* v)=0;
   virtual void init(TheNtupleMaker* eda, std::string label)=0;
+  virtual void fuse()=0;
+  virtual void defer(bool fuse)=0;
+  virtual void compile()=0;
+  virtual void useNative(bool yes)=0;
+  virtual void useArrays(bool yes)=0;
+  virtual void select(std::string cut)=0;
+  virtual void bind(std::string classname, 
+		    long unsigned int address,
+		    long unsigned int function)=0;
   virtual void get(const edm::Event& event)=0;
+  virtual void fetch(const edm::Event& event)=0;
+  virtual void fill()=0;
+  virtual bool isNative()=0;
+  virtual size_t size()=0;
+  virtual void openFile(bool skipMissing)=0;
+  virtual long missingCount()=0;
+  virtual std::string productName()=0;
   static int count;
 };
 int BufferThing::count = 0;
@@ -141,15 +200,20 @@ struct VariableDescriptor
       method(""),
       varname(""),
       branchname(""),
-      maxcount(0)
+      maxcount(0),
+      bits(0),
+      packed(false)
   {}
 
-  VariableDescriptor(std::string r, std::string m, std::string v)
+  VariableDescriptor(std::string r, std::string m, std::string v,
+		     int b=0, bool p=false)
     : rtype(r),
       method(m),
       varname(v),
       branchname(""),
-      maxcount(0)
+      maxcount(0),
+      bits(b),
+      packed(p)
   {}
 
   ~VariableDescriptor() {}
@@ -159,6 +223,110 @@ struct VariableDescriptor
   std::string varname;     /// Name of variable derived from method
   std::string branchname;  /// Name of branch associated with method
   int         maxcount;    /// Maximum count associated with method
+  int         bits;        /// If > 0, mantissa bits of stored float
+  bool        packed;      /// If true, bool packed into flags branch
+};
+
+// ----------------------------------------------------------------------------
+// ----------------------------------------------------------------------------
+// ----------------------------------------------------------------------------
+/** Handle to an instance of a compiled getter class, that is, a struct
+    with the method
+    void get(const void* oaddr, const void* vaddr),
+    and to a plain function, with the same signature, that calls the method.
+    If the address of the plain function is known, and native calls have 
+    not been switched off, the get method is called directly through the 
+    function pointer. Otherwise, the call goes through the interpreter.
+*/
+struct Getter
+{
+  typedef void (*Function)(const void*, const void*);
+
+  Getter()
+    : classname(""),
+      getter_class(0),
+      getter(0),
+      address(0),
+      function(0),
+      native(true)
+  {}
+
+  ~Getter() {}
+
+  /** 
+      @brief Bind handle to the getter class instance at the given address.
+      @param classname_ - name of getter class
+      @param address_   - address of getter class instance
+      @param function_  - address of function that calls get method
+   */
+  void bind(std::string classname_, 
+	    long unsigned int address_,
+	    long unsigned int function_=0)
+  {
+    classname = classname_;
+    address   = address_;
+    function  = (Function)function_;
+
+    if ( native && !function )
+      edm::LogWarning("NativeGetterFailure") 
+	<< "unable to get address of function " << classname << "_get"
+	<< "; will call getter through the interpreter" << std::endl;
+
+    // --------------------------------------------------
+    // get object representing getter class
+    // --------------------------------------------------
+    getter_class = TClass::GetClass(classname.c_str());
+    if ( !getter_class )
+      // Have a tantrum!
+      throw edm::Exception(edm::errors::Configuration,
+			   "cfg error: "
+			   + BOLDRED +
+			   "unable to get " + classname
+			   + DEFAULT_COLOR);
+
+    // --------------------------------------------------
+    // get instance of "get" method of getter class
+    // --------------------------------------------------
+    getter = getter_class->GetMethod("get", "0,0");
+    if ( !getter )
+      // Have another tantrum!
+      throw edm::Exception(edm::errors::Configuration,
+			   "cfg error: " + BOLDRED +
+			   "unable to get get method of " + classname
+    			   + DEFAULT_COLOR);
+  }
+
+  /** Execute get method of getter class.
+      @param oaddr - address of EDM object
+      @param vaddr - address of buffer(s) to receive data
+   */
+  void get(const void* oaddr, const void* vaddr)
+  {
+    // direct call of compiled code
+    if ( native && function ) 
+      {
+	function(oaddr, vaddr);
+	return;
+      }
+
+    long unsigned int o = (long unsigned int)oaddr;
+    long unsigned int v = (long unsigned int)vaddr;
+
+    // execute call to "get". since we have already compiled the code
+    // the call should be fast.
+    const void* args[] = {&o, &v};
+    gInterpreter->ExecuteWithArgsAndReturn(getter, (void*)address, args, 2);
+  }
+
+  /// True if the get method is called directly, not via the interpreter.
+  bool isNative() const { return native && function; }
+
+  std::string classname;           /// name of getter class
+  TClass*  getter_class;           /// pointer to getter class
+  TMethod* getter;                 /// pointer to get method of getter class
+  long unsigned int address;       /// adress of getter class instance
+  Function function;               /// function that calls get method
+  bool     native;                 /// if true, call function directly
 };
 
 // ----------------------------------------------------------------------------
@@ -167,6 +335,51 @@ struct VariableDescriptor
 // We need a few templates to make the code generic. 
 // ----------------------------------------------------------------------------
 
+/** Store the values of a nested variable, that is, one whose return type
+    is std::vector<E>, as a flat content vector plus a vector of offsets: 
+    the values of object c are content[offsets[c]] ... 
+    content[offsets[c+1]-1]. Other return types are not flattened.
+*/
+template <typename R>
+struct Flattener
+{
+  bool init(TTree* tree, std::string branchname) { return false; }
+  void flush(const std::vector<R>& value) {}
+};
+
+template <typename E>
+struct Flattener< std::vector<E> >
+{
+  bool init(TTree* tree, std::string branchname)
+  {
+    tree->Branch(branchname.c_str(), &content);
+    tree->Branch((branchname + "_offsets").c_str(), &offsets);
+    return true;
+  }
+
+  void flush(const std::vector<std::vector<E> >& value)
+  {
+    content.clear();
+    offsets.clear();
+    offsets.push_back(0);
+    for(size_t c=0; c < value.size(); c++)
+      {
+	content.insert(content.end(), value[c].begin(), value[c].end());
+	offsets.push_back((int)content.size());
+      }
+  }
+
+  std::vector<E>   content;        /// values of all objects
+  std::vector<int> offsets;        /// offsets of values of each object
+};
+
+/// Return value as a number, or zero if it is not a number.
+template <typename R>
+inline double tnm_number(const R& x, std::true_type) { return (double)x; }
+
+template <typename R>
+inline double tnm_number(const R& x, std::false_type) { return 0; }
+
 /** Model a variable.
     X     - object type (this could also be a simple type or a vector of such)
     RTYPE - return type
@@ -175,7 +388,7 @@ template <typename X, typename RTYPE>
   struct Variable : public VariableThing
 {
 
-  virtual ~Variable() {}
+  virtual ~Variable() { if ( array ) delete [] array; }
   
   /** 
       @brief Model a variable as an object comprising a method, a branch name 
@@ -183,17 +396,12 @@ template <typename X, typename RTYPE>
       @param method_      - name of getter method
       @param maxcount_    - maximum number of values/variable
       @param branchname_  - name of branch associated with getter
+      @param compile_     - if false, do not compile a getter for this 
+                            variable (e.g., the buffer uses a fused getter)
    */
-  Variable(std::string method_, int maxcount_, std::string branchname_)
+  Variable(std::string method_, int maxcount_, std::string branchname_,
+	   bool compile_=true)
   {
-    // create name of getter class
-    sprintf(TNM_RECORD, "Getter%d", count);
-    getter_classname  = std::string(TNM_RECORD);
-
-    // create name of getter instance
-    sprintf(TNM_RECORD, "getter%d", count);
-    getter_objectname = std::string(TNM_RECORD);
-
     // value is the buffer to receive return data from getter
     value      = std::vector<RTYPE>(maxcount_);
 
@@ -202,6 +410,70 @@ template <typename X, typename RTYPE>
     branchname = branchname_;
     otype      = boost::python::type_id<X>().name();
     rtype      = boost::python::type_id<RTYPE>().name();
+    bits       = 0;
+    packed     = false;
+    flatten    = false;
+    array      = 0;
+
+    if ( compile_ ) compile();
+  }
+
+  /// Write and compile the getter class for this variable.
+  virtual void compile()
+  {
+    std::string key = tnm_getter_key(otype, rtype, method, maxcount);
+
+    // --------------------------------------------------
+    // identical getters are compiled only once and their
+    // instance shared.
+    // --------------------------------------------------
+    long unsigned int address  = 0;
+    long unsigned int function = 0;
+    if ( tnm_find_getter(key, getter_classname, address, function) )
+      {
+	getter_code = std::string("// shared getter: ") + getter_classname;
+	std::ofstream fout(".jit_code.cc");
+	fout << getter_code << std::endl;
+	fout.close();
+
+	getter.bind(getter_classname, address, function);
+	return;
+      }
+
+    // --------------------------------------------------
+    // if the getter library cache is enabled, try to
+    // load a previously compiled getter. the name of the
+    // getter class is derived from a hash of its key.
+    // --------------------------------------------------
+    if ( tnm_getter_cache() != "" )
+      {
+	getter_classname = tnm_getter_classname(key);
+	getter_code = tnm_write_getter_struct(getter_classname,
+					      method,
+					      otype,
+					      rtype,
+					      maxcount);
+	std::ofstream fout(".jit_code.cc");
+	fout << getter_code << std::endl;
+	fout.close();
+
+	if ( tnm_load_cached_getter(getter_classname, getter_code, otype,
+				    address, function) )
+	  {
+	    getter.bind(getter_classname, address, function);
+	    tnm_register_getter(key, getter_classname, address, function);
+	    return;
+	  }
+      }
+
+    // create name of getter class
+    sprintf(TNM_RECORD, "Getter%d", count);
+    getter_classname  = std::string(TNM_RECORD);
+
+    // create name of getter instance
+    sprintf(TNM_RECORD, "getter%d", count);
+    getter_objectname = std::string(TNM_RECORD);
+
     // --------------------------------------------------
     // write getter class to handle call to method.
     // Note, however, that X can be either a simple type, 
@@ -230,32 +502,13 @@ template <typename X, typename RTYPE>
 	
     // --------------------------------------------------
     // compile with JIT compiler and return address of
-    // getter class instance
+    // getter class instance and of the function that
+    // calls its get method
     // --------------------------------------------------
-    gROOT->ProcessLine(Form(code.c_str(), &address));
+    gROOT->ProcessLine(Form(code.c_str(), &address, &function));
+    getter.bind(getter_classname, address, function);
+    tnm_register_getter(key, getter_classname, address, function);
 
-    // --------------------------------------------------
-    // get object representing getter class
-    // --------------------------------------------------
-    getter_class = TClass::GetClass(getter_classname.c_str());
-    if ( !getter_class )
-      // Have a tantrum!
-      throw edm::Exception(edm::errors::Configuration,
-			   "cfg error: "
-			   + BOLDRED +
-			   "unable to get " + getter_classname
-			   + DEFAULT_COLOR);
-
-    // --------------------------------------------------
-    // get instance of "get" method of getter class
-    // --------------------------------------------------
-    getter = getter_class->GetMethod("get", "0,0");
-    if ( !getter )
-      // Have another tantrum!
-      throw edm::Exception(edm::errors::Configuration,
-			   "cfg error: " + BOLDRED +
-			   "unable to get get method of " + getter_classname
-    			   + DEFAULT_COLOR);
     // IMPORTANT: update!
     count++;
   }
@@ -266,23 +519,92 @@ template <typename X, typename RTYPE>
    */
   virtual void get(const void* objaddress)
   {
-    // address of EDM object
-    long unsigned int oaddr = (long unsigned int)objaddress;
+    getter.get(objaddress, &value);
+    if ( bits > 0 ) truncate();
+  }
 
-    // address of buffer to receive data
-    long unsigned int vaddr = (long unsigned int)&value;
+  /// Address of buffer that receives the data.
+  virtual void* valueAddress() { return &value; }
 
-    // address of getter class instance
-    void* object = (void*)address;
+  /// Reduce the precision of the values, if requested.
+  virtual void truncate() { tnm_truncate(value, bits); }
 
-    // execute call to "get". since we have already compiled the code
-    // above, the call should be fast.
-    const void* args[] = {&oaddr, &vaddr};
-    gInterpreter->ExecuteWithArgsAndReturn(getter, object, args, 2);
+  /// Number of values returned by the getter.
+  virtual size_t size() { return value.size(); }
+
+  /// First value as a number (see the event filter).
+  virtual double number()
+  {
+    if ( value.size() == 0 ) return 0;
+    return tnm_number<RTYPE>(value[0], std::is_arithmetic<RTYPE>());
+  }
+
+  /// Copy the first n values into the array branch (array layout) or 
+  /// flatten the values (nested layout).
+  virtual void flush(int n)
+  {
+    if ( flatten ) flattener.flush(value);
+    if ( ! array ) return;
+    int m = std::min(n, (int)value.size());
+    for(int c=0; c < m; c++) array[c] = value[c];
+    for(int c=m; c < n; c++) array[c] = RTYPE();
+  }
+
+  /// Forget the values of the previous event (e.g., the product is 
+  /// missing). The buffer of a singleton keeps one (default) value since 
+  /// its address is that of its branch.
+  virtual void clear()
+  {
+    if ( maxcount == 1 )
+      value.assign(1, RTYPE());
+    else
+      value.clear();
+  }
+
+  /// If false, call getter through the interpreter.
+  virtual void useNative(bool yes) { getter.native = yes; }
+
+  /// True if the getter is called directly, not via the interpreter.
+  virtual bool isNative() { return getter.isNative(); }
+
+  /// Bind variable to a getter compiled elsewhere.
+  virtual void bind(std::string classname, 
+		    long unsigned int address,
+		    long unsigned int function)
+  {
+    getter_classname = classname;
+    getter.bind(classname, address, function);
   }
 
   virtual void init(TTree* tree)
   {
+    // a packed flag is stored in the flags branch of its buffer
+    if ( packed ) return;
+
+    // nested layout: flatten the values of a collection variable whose
+    // return type is a vector.
+    flatten = flatten && maxcount > 1 && flattener.init(tree, branchname);
+    if ( flatten ) return;
+
+    // array layout: a variable-length array whose length is given by the
+    // counter branch of the buffer. types without a leaflist code, e.g.,
+    // strings, are stored as vectors.
+    if ( counter != "" && maxcount > 1 )
+      {
+	std::string leaftype = tnm_leaf_type(rtype);
+	if ( leaftype != "" )
+	  {
+	    std::string name = tnm_array_branchname(branchname);
+	    std::string leaflist = name + "[" + counter + "]/" + leaftype;
+	    array = new RTYPE[maxcount];
+	    tree->Branch(name.c_str(), array, leaflist.c_str());
+	    return;
+	  }
+	edm::LogWarning("ArrayLayout")
+	  << "cannot store " << rtype << " in an array; "
+	  << branchname << " is stored as a vector" << std::endl;
+      }
+
     // assume that maxcount > 1 => a collection and a singleton otherwise
     if ( maxcount > 1 )
       tree->Branch(branchname.c_str(), &value);
@@ -305,19 +627,14 @@ template <typename X, typename RTYPE>
 			   + DEFAULT_COLOR);
   }
 
-  std::string branchname;          /// name of branch associated with method
-  std::string otype;               /// object type (could also be a simple type)
-  std::string rtype;               /// return type of method
-  std::string method;              /// method
   std::string getter_classname;    /// name of getter class
   std::string getter_objectname;   /// name of getter instance
   std::string getter_code;         /// code associated with variable
-  int         maxcount;            /// maximum count/variable  
   std::vector<RTYPE> value;        /// buffer for returned values
+  RTYPE* array;                    /// buffer of array branch (array layout)
+  Flattener<RTYPE> flattener;      /// flat buffers (nested layout)
 
-  TClass*  getter_class;           /// pointer to getter class
-  TMethod* getter;                 /// pointer to get method of getter class
-  long unsigned int address;       /// adress of getter class instance
+  Getter getter;                   /// handle to getter class instance
 };
 
 // ----------------------------------------------------------------------------
@@ -331,9 +648,21 @@ template <typename T>
 struct Buffer : public BufferThing
 {
   Buffer() :
+    found(false),
     tree(0),
     var(std::vector<VariableThing*>()),
-    label("")
+    label(""),
+    fused(false),
+    vaddr(std::vector<void*>()),
+    index(count),
+    compiled(true),
+    fusing(false),
+    native(true),
+    available(-1),
+    skip(false),
+    missing(0),
+    arrays(false),
+    ncount(0)
   {
     count++;
   }
@@ -359,19 +688,386 @@ struct Buffer : public BufferThing
     token = eda->getToken<T>(label_);
     tree  = eda->getTree();
     label = label_;
+
+    // array layout: a counter branch n<block> gives the length of the 
+    // array branch of every variable of a collection.
+    arrays = arrays && var.size() > 0 && var[0]->maxcount > 1;
+    if ( arrays )
+      {
+	std::string counter = tnm_counter_branchname(var[0]->branchname);
+	tree->Branch(counter.c_str(), &ncount, (counter + "/I").c_str());
+	for(size_t c=0; c < var.size(); c++) var[c]->counter = counter;
+      }
+
     // initiaize every variable
     for(size_t c=0; c < var.size(); c++) var[c]->init(tree);
+
+    // variables whose precision is reduced, flags to be packed and
+    // variables to be copied into array or flat branches after each get
+    for(size_t c=0; c < var.size(); c++)
+      {
+	if ( var[c]->bits > 0 ) truncated.push_back(var[c]);
+	if ( var[c]->packed )   flags.push_back(var[c]);
+	if ( arrays || var[c]->flatten ) flushed.push_back(var[c]);
+      }
+    if ( flags.size() == 0 ) return;
+
+    if ( flags.size() > 64 )
+      throw edm::Exception(edm::errors::Configuration,
+			   "cfg error: "
+			   + BOLDRED +
+			   "more than 64 flags (as bit) for " + label
+			   + DEFAULT_COLOR);
+
+    // the flags are packed into a single branch, one word per object, of
+    // the smallest type that holds them. see the flags branch of the
+    // Provenance tree for the decoding table.
+    std::string branchname = tnm_flag_branchname(flags[0]->branchname);
+    int maxcount = flags[0]->maxcount;
+    if      ( flags.size() <= 8 )
+      branchFlags(flags8,  branchname, "b", maxcount);
+    else if ( flags.size() <= 16 )
+      branchFlags(flags16, branchname, "s", maxcount);
+    else if ( flags.size() <= 32 )
+      branchFlags(flags32, branchname, "i", maxcount);
+    else
+      branchFlags(flags64, branchname, "l", maxcount);
   }
+
+  /// Create the branch of the packed flags, with words of type W whose
+  /// leaflist code is leaftype.
+  template <typename W>
+  void branchFlags(std::vector<W>& words, std::string branchname,
+		   std::string leaftype, int maxcount)
+  {
+    words = std::vector<W>(maxcount);
+    if ( arrays )
+      {
+	branchname = tnm_array_branchname(branchname);
+	std::string leaflist = branchname + "[" + flags[0]->counter + "]/"
+	  + leaftype;
+	tree->Branch(branchname.c_str(), &words[0], leaflist.c_str());
+      }
+    else if ( maxcount > 1 )
+      tree->Branch(branchname.c_str(), &words);
+    else
+      tree->Branch(branchname.c_str(), &words[0]);
+  }
+
+  /**
+     @brief Write and compile a single getter for all Variables of the
+     buffer. The fused getter walks the collection once per event and
+     fills the buffers of all Variables, which should have been created
+     without getters of their own.
+  */
+  virtual void fuse()
+  {
+    if ( var.size() == 0 ) return;
+
+    std::vector<std::string> methods;
+    std::vector<std::string> rtypes;
+    for(size_t c=0; c < var.size(); c++)
+      {
+	methods.push_back(var[c]->method);
+	rtypes.push_back(var[c]->rtype);
+      }
+
+    // create names of fused getter class and instance
+    sprintf(TNM_RECORD, "FusedGetter%d", index);
+    std::string getter_classname(TNM_RECORD);
+    sprintf(TNM_RECORD, "fusedgetter%d", index);
+    std::string getter_objectname(TNM_RECORD);
+
+    std::string key = tnm_fused_getter_key(var[0]->otype,
+					   rtypes,
+					   methods,
+					   var[0]->maxcount,
+					   cut);
+
+    // share the fused getter of an identical buffer (same class, methods
+    // and maxcount, but a different label)
+    long unsigned int address  = 0;
+    long unsigned int function = 0;
+    std::string classname("");
+    if ( tnm_find_getter(key, classname, address, function) )
+      {
+	std::ofstream fout(".jit_code.cc");
+	fout << "// shared getter: " << classname << std::endl;
+	fout.close();
+
+	bind(classname, address, function);
+	return;
+      }
+
+    // if the getter library cache is enabled, try to load a previously
+    // compiled fused getter.
+    if ( tnm_getter_cache() != "" )
+      {
+	classname = tnm_getter_classname(key);
+	std::string code = tnm_write_fused_struct(classname,
+						  methods,
+						  var[0]->otype,
+						  rtypes,
+						  var[0]->maxcount,
+						  cut);
+	std::ofstream fout(".jit_code.cc");
+	fout << code << std::endl;
+	fout.close();
+
+	if ( tnm_load_cached_getter(classname, code, var[0]->otype,
+				    address, function) )
+	  {
+	    bind(classname, address, function);
+	    tnm_register_getter(key, classname, address, function);
+	    return;
+	  }
+      }
+
+    // all variables of a buffer have the same object type and maxcount
+    std::string code = tnm_write_fused_code(getter_classname,
+					    getter_objectname,
+					    methods,
+					    var[0]->otype,
+					    rtypes,
+					    var[0]->maxcount,
+					    index,
+					    cut);
+    std::ofstream fout(".jit_code.cc");
+    fout << code << std::endl;
+    fout.close();
+
+    if ( DEBUG < 0 )
+      {
+	std::cout << BOLDYELLOW 
+		  << "--------------------------------------------------------"
+		  << DEFAULT_COLOR << std::endl;
+	std::cout << BOLDGREEN << code << DEFAULT_COLOR << std::endl;
+      }
+
+    // compile and return address of fused getter instance and of
+    // the function that calls its get method
+    gROOT->ProcessLine(Form(code.c_str(), &address, &function));
+    bind(getter_classname, address, function);
+    tnm_register_getter(key, getter_classname, address, function);
+  }
+
+  /// Bind buffer to a fused getter compiled elsewhere.
+  virtual void bind(std::string classname, 
+		    long unsigned int address,
+		    long unsigned int function)
+  {
+    vaddr.clear();
+    for(size_t c=0; c < var.size(); c++) 
+      vaddr.push_back(var[c]->valueAddress());
+    getter.bind(classname, address, function);
+    fused = true;
+  }
+
+  /// If false, call getters through the interpreter.
+  virtual void useNative(bool yes)
+  {
+    native = yes;
+    getter.native = yes;
+    for(size_t c=0; c < var.size(); c++) var[c]->useNative(yes);
+  }
+
+  /// True if every getter of the buffer is called directly. Only such
+  /// buffers may be filled concurrently (see fill).
+  virtual bool isNative()
+  {
+    if ( ! compiled ) return false;
+    if ( fused ) return getter.isNative();
+    for(size_t c=0; c < var.size(); c++) 
+      if ( ! var[c]->isNative() ) return false;
+    return true;
+  }
+
+  /// If true, store collections as a counter plus arrays (call before init).
+  virtual void useArrays(bool yes) { arrays = yes; }
+
+  /**
+     @brief Store only objects that pass the given cut, e.g., 
+     pt() > 20 && abs(eta()) < 2.5. The cut is evaluated in the loop of the
+     fused getter, so a buffer with a cut must be fused (call before fuse).
+  */
+  virtual void select(std::string cut_) { cut = cut_; }
   
+  /**
+     @brief Defer the compilation of the getters until the product is
+     first found (see get).
+     @param fuse_ - if true, compile a fused getter rather than one getter
+     per variable.
+  */
+  virtual void defer(bool fuse_)
+  {
+    compiled = false;
+    fusing   = fuse_;
+  }
+
+  /// Compile the getters of a buffer whose compilation was deferred.
+  virtual void compile()
+  {
+    if ( compiled ) return;
+    std::cout << "compiling getters for "
+	      << boost::python::type_id<T>().name()
+	      << " with label " << label << std::endl;
+    if ( fusing )
+      fuse();
+    else
+      for(size_t c=0; c < var.size(); c++) var[c]->compile();
+    useNative(native);
+    compiled = true;
+  }
+
+  /// Pack flags into one word per object, flag c into bit c.
+  void pack()
+  {
+    if      ( flags.size() <= 8 )  packFlags(flags8);
+    else if ( flags.size() <= 16 ) packFlags(flags16);
+    else if ( flags.size() <= 32 ) packFlags(flags32);
+    else                           packFlags(flags64);
+  }
+
+  template <typename W>
+  void packFlags(std::vector<W>& words)
+  {
+    size_t n = 0;
+    for(size_t c=0; c < flags.size(); c++)
+      n = std::max(n, ((std::vector<bool>*)flags[c]->valueAddress())->size());
+    // the address of an array branch must not change
+    if ( arrays )
+      n = std::min(n, words.size());
+    else if ( flags[0]->maxcount > 1 )
+      words.resize(n);
+
+    for(size_t k=0; k < n; k++)
+      {
+	ULong64_t word = 0;
+	for(size_t c=0; c < flags.size(); c++)
+	  {
+	    std::vector<bool>* v = (std::vector<bool>*)flags[c]->valueAddress();
+	    if ( k < v->size() && (*v)[k] ) word |= 1ULL << c;
+	  }
+	words[k] = (W)word;
+      }
+  }
+
+  /// Number of objects stored.
+  virtual size_t size()
+  {
+    if ( arrays ) return ncount;
+    if ( var.size() == 0 ) return 0;
+    return var[0]->size();
+  }
+
+  /// Set the counter and copy the values into the array or flat branches.
+  void flush()
+  {
+    if ( arrays )
+      {
+	size_t n = 0;
+	for(size_t c=0; c < var.size(); c++) n = std::max(n, var[c]->size());
+	ncount = (int)std::min(n, (size_t)var[0]->maxcount);
+      }
+    for(size_t c=0; c < flushed.size(); c++) flushed[c]->flush(ncount);
+  }
+
+  /**
+     @brief Reset the availability of the product when a new input file is
+     opened.
+     @param skipMissing - if true, a product missing from the first event
+     of the file is assumed to be missing from the whole file and is no
+     longer looked for.
+  */
+  virtual void openFile(bool skipMissing)
+  {
+    available = -1;
+    skip = skipMissing;
+  }
+
+  /// Return number of events in which the product was missing.
+  virtual long missingCount() { return missing; }
+
+  /// Return type and label of product.
+  virtual std::string productName()
+  {
+    return std::string(boost::python::type_id<T>().name()) + " " + label;
+  }
+
+  /**
+     @brief Get product. Return false if it is missing.
+     A missing product is counted rather than reported, which is done
+     once at the end of the job.
+  */
+  bool getProduct(const edm::Event& event, edm::Handle<T>& object)
+  {
+    // skip a product known to be missing from the current file
+    if ( available == 0 )
+      {
+	missing++;
+	return false;
+      }
+
+    event.getByToken(token, object);
+    if ( ! object.isValid() )
+      {
+	if ( available < 0 && skip ) available = 0;
+	missing++;
+	return false;
+      }
+    available = 1;
+    return true;
+  }
+
   /// Get data from associated object by calling specified methods.
   virtual void get(const edm::Event& event)
   {
-    edm::Handle<T> object;
+    fetch(event);
+    fill();
+  }
+
+  /**
+     @brief Get the product from the event. This must be done on the 
+     module thread since edm::Event is not safe for concurrent gets.
+  */
+  virtual void fetch(const edm::Event& event)
+  {
+    found = getProduct(event, object);
+    if ( ! found )
+      {
+	// the values of the previous event must not be stored again, nor
+	// be seen by the event filter
+	for(size_t c=0; c < var.size(); c++) var[c]->clear();
+	if ( flags.size() > 0 ) pack();
+	ncount = 0;
+	flush();
+	return;
+      }
+
+    // if compilation was deferred, compile the getters now that the
+    // product has been found.
+    if ( ! compiled ) compile();
+  }
+
+  /**
+     @brief Call the getters for the product found by fetch. Buffers whose
+     getters are all native (see isNative) may be filled concurrently.
+  */
+  virtual void fill()
+  {
+    if ( ! found ) return;
     try
       {
-	event.getByToken(token, object);
 	const T* pobject = &(*object);
-	for(size_t c=0; c < var.size(); c++) var[c]->get( pobject );
+	if ( fused )
+	  {
+	    getter.get(pobject, &vaddr[0]);
+	    for(size_t c=0; c < truncated.size(); c++) 
+	      truncated[c]->truncate();
+	  }
+	else
+	  for(size_t c=0; c < var.size(); c++) var[c]->get( pobject );
+	if ( flags.size() > 0 ) pack();
       }
     catch (...)
       {
@@ -382,12 +1078,177 @@ struct Buffer : public BufferThing
 	  << DEFAULT_COLOR
 	  << std::endl;
       }
+    flush();
   }
   
   edm::EDGetTokenT<T> token;
+  edm::Handle<T> object;           /// product of current event
+  bool   found;                    /// true if product of current event found
   TTree* tree;
   std::vector<VariableThing*> var; /// Models variables associated with buffer
   std::string label;
+  bool   fused;                    /// true if buffer uses a fused getter
+  std::vector<void*> vaddr;        /// addresses of variable buffers
+  int    index;                    /// buffer number
+  Getter getter;                   /// handle to fused getter
+  bool   compiled;                 /// false until getters are compiled
+  bool   fusing;                   /// true if a fused getter is deferred
+  bool   native;                   /// true if getters are called natively
+  int    available;                /// product in file? -1 (unknown), 0, 1
+  bool   skip;                     /// true if missing products are skipped
+  long   missing;                  /// number of events with missing product
+  std::vector<VariableThing*> truncated; /// variables of reduced precision
+  std::vector<VariableThing*> flags;     /// flags packed into one word
+  std::vector<UChar_t>   flags8;         /// packed flags, up to 8
+  std::vector<UShort_t>  flags16;        /// packed flags, up to 16
+  std::vector<UInt_t>    flags32;        /// packed flags, up to 32
+  std::vector<ULong64_t> flags64;        /// packed flags, up to 64
+  bool   arrays;                   /// true if array layout is used
+  int    ncount;                   /// counter of array layout
+  std::vector<VariableThing*> flushed;   /// variables copied after get
+  std::string cut;                 /// object selection (fused getter only)
+};
+
+// ----------------------------------------------------------------------------
+/**
+   @brief A buffer for a product of simple type X, or of type std::vector<X>,
+   that is copied, in bulk, directly into the buffer of its (only) Variable.
+   No getter is needed.
+ */
+template <typename T, typename X>
+struct SimpleBuffer : public Buffer<T>
+{
+  SimpleBuffer() : Buffer<T>() {}
+  virtual ~SimpleBuffer() {}
+
+  /// There is nothing to compile.
+  virtual void fuse() {}
+  virtual void compile() { this->compiled = true; }
+
+  /// There are no getters.
+  virtual bool isNative() { return true; }
+
+  /// Copy product into the buffer of each Variable.
+  virtual void fill()
+  {
+    if ( ! this->found ) return;
+    const T& product = *(this->object);
+    for(size_t c=0; c < this->var.size(); c++)
+      copy(product, 
+	   (std::vector<X>*)this->var[c]->valueAddress(), 
+	   this->var[c]->maxcount);
+    this->flush();
+  }
+
+  // the address of the first element of the buffer of a singleton must not
+  // change, so the value is assigned in place.
+  static void copy(const X& o, std::vector<X>* v, int maxcount)
+  {
+    (*v)[0] = o;
+  }
+
+  static void copy(const std::vector<X>& o, std::vector<X>* v, int maxcount)
+  {
+    size_t n = std::min(o.size(), (size_t)maxcount);
+    v->assign(o.begin(), o.begin() + n);
+  }
+};
+
+// ----------------------------------------------------------------------------
+/**
+   @brief A buffer that stores the decisions of selected triggers as bits:
+   the decision of trigger k is bit k%64 of word k/64 of the branch. The
+   triggers are resolved to indices into edm::TriggerResults once per run 
+   (see setTriggers), so that no lookup by name is needed per event. 
+ */
+struct TriggerBuffer : public BufferThing
+{
+  TriggerBuffer(std::string branchname_, edm::InputTag tag_) : 
+    branchname(branchname_),
+    tag(tag_),
+    missing(0)
+  {}
+  virtual ~TriggerBuffer() {}
+
+  /// There are no variables and nothing to compile.
+  virtual void add(VariableThing* v) {}
+  virtual void fuse() {}
+  virtual void defer(bool fuse) {}
+  virtual void compile() {}
+  virtual void useNative(bool yes) {}
+  virtual bool isNative() { return true; }
+  virtual void useArrays(bool yes) {}
+  virtual void select(std::string cut) {}
+  virtual void bind(std::string classname, 
+		    long unsigned int address,
+		    long unsigned int function) {}
+
+  virtual void init(TheNtupleMaker* eda, std::string label)
+  {
+    token = eda->getToken<edm::TriggerResults>(tag);
+    eda->getTree()->Branch(branchname.c_str(), &bits);
+  }
+
+  /// Set the indices (into edm::TriggerResults) of the selected triggers.
+  void setTriggers(const std::vector<unsigned int>& index_)
+  {
+    index = index_;
+    bits  = std::vector<ULong64_t>((index.size() + 63) / 64);
+  }
+
+  /// Get trigger decisions.
+  virtual void get(const edm::Event& event)
+  {
+    fetch(event);
+    fill();
+  }
+
+  /// Get edm::TriggerResults (on the module thread).
+  virtual void fetch(const edm::Event& event)
+  {
+    event.getByToken(token, results);
+    if ( ! results.isValid() ) missing++;
+  }
+
+  /// Unpack the decisions of the selected triggers.
+  virtual void fill()
+  {
+    std::fill(bits.begin(), bits.end(), 0);
+    if ( ! results.isValid() ) return;
+
+    for(size_t k=0; k < index.size(); k++)
+      if ( index[k] < results->size() && results->accept(index[k]) )
+	bits[k / 64] |= 1ULL << (k % 64);
+  }
+
+  /// Number of selected triggers.
+  virtual size_t size() { return index.size(); }
+
+  /// Return decision of selected trigger k.
+  bool fired(size_t k)
+  {
+    if ( k >= index.size() ) return false;
+    return (bits[k / 64] >> (k % 64)) & 1;
+  }
+
+  virtual void openFile(bool skipMissing) {}
+
+  /// Return number of events in which the product was missing.
+  virtual long missingCount() { return missing; }
+
+  /// Return type and label of product.
+  virtual std::string productName()
+  {
+    return std::string("edm::TriggerResults ") + tag.encode();
+  }
+
+  std::string branchname;
+  edm::InputTag tag;
+  edm::EDGetTokenT<edm::TriggerResults> token;
+  edm::Handle<edm::TriggerResults> results; /// product of current event
+  long   missing;                  /// number of events with missing product
+  std::vector<unsigned int> index; /// indices of selected triggers
+  std::vector<ULong64_t> bits;     /// trigger decisions
 };
 
 #endif
@@ -5,7 +5,20 @@
 // Created: 15 Oct 2020 HBP
 //-----------------------------------------------------------------------------
 #include <string>
+#include <vector>
+#include <cstring>
 //-----------------------------------------------------------------------------
+std::string tnm_write_getter_struct(std::string getter_classname,
+				    std::string method,
+				    std::string otype,
+				    std::string rtype,
+				    int maxcount);
+
+std::string tnm_write_instance_code(std::string getter_classname,
+				    std::string getter_objectname,
+				    std::string addrname,
+				    int count);
+
 std::string tnm_write_code(std::string getter_classname,
 			   std::string getter_objectname,
 			   std::string method,
@@ -13,4 +26,95 @@ std::string tnm_write_code(std::string getter_classname,
 			   std::string rtype,
 			   int maxcount,
 			     int count);
+
+std::string tnm_write_fused_struct(std::string getter_classname,
+				   std::vector<std::string>& methods,
+				   std::string otype,
+				   std::vector<std::string>& rtypes,
+				   int maxcount,
+				   std::string cut="");
+
+std::string tnm_write_fused_code(std::string getter_classname,
+				 std::string getter_objectname,
+				 std::vector<std::string>& methods,
+				 std::string otype,
+				 std::vector<std::string>& rtypes,
+				 int maxcount,
+				 int count,
+				 std::string cut="");
+
+std::string tnm_write_trampoline_code(std::string getter_classname,
+				      std::string getter_objectname);
+
+std::string tnm_hash(std::string str);
+
+std::string tnm_getter_key(std::string otype,
+			   std::string rtype,
+			   std::string method,
+			   int maxcount);
+
+std::string tnm_fused_getter_key(std::string otype,
+				 std::vector<std::string>& rtypes,
+				 std::vector<std::string>& methods,
+				 int maxcount,
+				 std::string cut="");
+
+void        tnm_set_getter_cache(std::string dirname, int maxsize);
+
+std::string tnm_getter_cache();
+
+std::string tnm_getter_classname(std::string key);
+
+bool        tnm_load_cached_getter(std::string getter_classname,
+				   std::string structcode,
+				   std::string otype,
+				   long unsigned int& address,
+				   long unsigned int& function);
+
+bool        tnm_find_getter(std::string key,
+			    std::string& getter_classname,
+			    long unsigned int& address,
+			    long unsigned int& function);
+
+void        tnm_register_getter(std::string key,
+				std::string getter_classname,
+				long unsigned int address,
+				long unsigned int function);
+
+std::string tnm_flag_branchname(std::string branchname);
+
+std::string tnm_array_branchname(std::string branchname);
+
+std::string tnm_counter_branchname(std::string branchname);
+
+std::string tnm_leaf_type(std::string rtype);
+
+std::string tnm_cut_expression(std::string cut);
+
+std::string tnm_derived_expression(std::string expr,
+				   std::vector<std::string>& names);
+
+/// Round a float to the given number of mantissa bits (1 to 22).
+inline float tnm_truncate(float x, int bits)
+{
+  if ( bits <= 0 || bits >= 23 ) return x;
+  unsigned int u;
+  std::memcpy(&u, &x, sizeof(u));
+  if ( (u & 0x7f800000) != 0x7f800000 ) // leave inf and nan alone
+    {
+      u += 1u << (22 - bits);
+      u &= ~((1u << (23 - bits)) - 1);
+    }
+  std::memcpy(&x, &u, sizeof(x));
+  return x;
+}
+
+inline void tnm_truncate(std::vector<float>& v, int bits)
+{
+  for(size_t c=0; c < v.size(); c++) v[c] = tnm_truncate(v[c], bits);
+}
+
+/// Only floats are truncated.
+template <typename T>
+inline void tnm_truncate(std::vector<T>& v, int bits) {}
 #endif
@@ -75,10 +75,16 @@
 #include <vector>
 #include <string>
 #include <cmath>
+#include <cctype>
 #include <iostream>
 #include <fstream>
+#include <sstream>
 #include <cassert>
 #include <map>
+#include <set>
+#include <cstdio>
+#include <unistd.h>
+#include <fcntl.h>
 #include <time.h>
 #include <stdlib.h>
 
@@ -87,14 +93,22 @@
 #include "PhysicsTools/TheNtupleMaker/interface/Configuration.h"
 #include "PhysicsTools/TheNtupleMaker/interface/kit.h"
 #include "DataFormats/PatCandidates/interface/Flags.h"
+#include "FWCore/Framework/interface/FileBlock.h"
+#include "FWCore/MessageLogger/interface/MessageLogger.h"
 
 // File service for output ROOT files
 #include "FWCore/ServiceRegistry/interface/Service.h"
 #include "CommonTools/UtilAlgos/interface/TFileService.h"
 
 #include "HLTrigger/HLTcore/interface/HLTConfigProvider.h"
+#include "HLTrigger/HLTcore/interface/HLTPrescaleProvider.h"
 
 #include "TStopwatch.h"
+#include "TBranch.h"
+#include "Compression.h"
+
+#include "tbb/task_arena.h"
+#include "tbb/parallel_for.h"
 // ---------------------------------------------------------------------------
 using namespace std;
 // ---------------------------------------------------------------------------
@@ -117,6 +131,9 @@ namespace {
   
   // addresses of buffers
   std::map<std::string, BufferThing*> buffermap;
+
+  // addresses of variables, by branch name
+  std::map<std::string, VariableThing*> variablemap;
   
   std::string ntuplename_;
   std::string analyzername_;
@@ -128,6 +145,53 @@ namespace {
   int logger_(0);
   bool haltlogger_(false);
   bool macroEnabled_(false);
+  bool fuseGetters_(false);
+  std::string getterMode_("native");
+  bool jitBatch_(false);
+  bool lazyJit_(false);
+  bool skipMissingProducts_(false);
+  bool arrayLayout_(false);
+  bool flattenNested_(false);
+
+  // optional concurrent evaluation of buffers within an event
+  int parallelBuffers_(0);
+  std::unique_ptr<tbb::task_arena> arena_;
+
+  // optional pre-sampling of events for quick-look ntuples: every Nth 
+  // event, a fraction of events chosen by a hash of (run, lumi, event), 
+  // and the first K events of each input file. Skipped events bypass all
+  // buffers.
+  int sampleEvery_(0);
+  double sampleFraction_(1);
+  int firstEventsPerFile_(0);
+  long seenCount_(0);
+  long fileEventCount_(0);
+
+  // optional event filter, a boolean expression in the object counts of
+  // collections (n<prefix>), singleton variables and triggers stored as
+  // bits. Only the buffers needed by the filter are called before it.
+  struct FilterOperand
+  {
+    std::string name;
+    BufferThing* buffer;      /// collection whose count is used
+    VariableThing* variable;  /// singleton variable
+    int bit;                  /// trigger bit, -1 if not in current menu
+  };
+  std::string eventFilter_;
+  std::vector<FilterOperand> filterOperands_;
+  std::vector<double> filterValues_;
+  bool (*filter_)(const double*)(0);
+  std::vector<BufferThing*> filterBuffers_;
+  std::vector<BufferThing*> otherBuffers_;
+  long keptCount_(0);
+
+  // output tuning
+  long autoFlush_(0);
+  long basketMemory_(0);
+  int  autoTuneEvents_(0);
+
+  // time spent filling (and compressing) the output tree
+  TStopwatch fillwatch_;
   
   TTree* ptree_;
   //int inputCount_;
@@ -137,13 +201,499 @@ namespace {
   HLTConfigProvider HLTconfig_;
   bool HLTconfigured(false);
   std::vector<std::string> triggerNames_;
+
+  // catalogue of HLT menus, one entry per menu, keyed by a hash of the 
+  // menu. The catalogue is written at the end of the job, when the range
+  // of runs of each menu is known.
+  struct MenuRecord
+  {
+    std::string hash;
+    std::string table;
+    std::vector<std::string> names;
+    unsigned int firstRun;
+    unsigned int lastRun;
+  };
+  TTree* mtree_(0);
+  std::map<std::string, MenuRecord> menus_;
+  MenuRecord menuRecord_;
+  std::string menuHash_;
+  std::string menuTable_;
+
+  // triggers matched by each pattern, per menu
+  std::map<std::string, boost::regex> triggerRegex_;
+  std::map<std::string, std::vector<unsigned int> > triggerMatches_;
+
+  // triggers stored as bits, and the per-run table of their names
+  std::vector<std::string> triggerPatterns_;
+  TriggerBuffer* triggerBuffer_(0);
+  TTree* ttree_(0);
+  unsigned int triggerRun_(0);
+  std::vector<std::string> triggerTable_;
+
+  // prescales, written once per lumi section to the tree Prescales
+  std::vector<std::string> prescalePatterns_;
+  std::unique_ptr<HLTPrescaleProvider> prescaleProvider_;
+  std::vector<std::string> prescaleNames_;
+  std::vector<double> prescaleValues_;
+  TTree* prescaleTree_(0);
+  unsigned int prescaleRun_(0);
+  unsigned int prescaleLumi_(0);
   
   // cache decoded config data
+  std::vector<std::string> className_;
+  std::vector<std::string> blockName_;
+  std::vector<std::string> bufferName_;
+  std::vector<std::string> label_;
+  std::vector<std::string> prefix_;
+  std::vector<int> maxcount_;
+  std::vector<bool> simpletype_;
+  std::vector<std::string> cut_;
+  std::vector<bool> derived_;
   std::vector<std::map<std::string, std::string> > parameters_;
   std::vector<std::vector<VariableDescriptor> > variables_;
 
   std::string DirectoryName;
 
+  // Decode storage annotation of a method (see the constructor). The 
+  // variable, e.g., "Jet: double pt() as float:12", is named in errors.
+  void decodeStorage(std::string storage, std::string variable,
+		     std::string& rtype, int& bits, bool& packed)
+  {
+    bits   = 0;
+    packed = false;
+    rtype  = storage;
+    if      ( storage == "uchar" )   rtype = "unsigned char";
+    else if ( storage == "ushort" )  rtype = "unsigned short";
+    else if ( storage == "uint" )    rtype = "unsigned int";
+    else if ( storage == "float16" || storage == "Float16_t" )
+      {
+	rtype = "float";
+	bits  = 10;
+      }
+    else if ( storage == "bit" )
+      {
+	rtype  = "bool";
+	packed = true;
+      }
+    else if ( storage.substr(0, 6) == "float:" )
+      {
+	rtype = "float";
+	bits  = atoi(storage.substr(6).c_str());
+	if ( bits < 1 || bits > 22 )
+	  // Have a tantrum!
+	  throw edm::Exception(edm::errors::Configuration,
+			       "cfg error: " + BOLDRED +
+			       "mantissa bits must be 1 to 22, not " 
+			       + storage.substr(6) + ", in \"as " + storage
+			       + "\" of " + variable
+			       + DEFAULT_COLOR);
+      }
+    else if ( storage != "float" && storage != "double" && 
+	      storage != "char"  && storage != "short"  && 
+	      storage != "int"   && storage != "long"   &&
+	      storage != "bool" )
+      // Have a tantrum!
+      throw edm::Exception(edm::errors::Configuration,
+			   "cfg error: " + BOLDRED +
+			   "unknown storage type in \"as " + storage
+			   + "\" of " + variable
+			   + DEFAULT_COLOR);
+  }
+
+  // Choose basket sizes and cluster size from the events written so far.
+  void tuneBaskets()
+  {
+    long nentries = (long)tree->GetEntries();
+    if ( nentries <= 0 ) return;
+
+    // choose the number of entries per cluster so that a cluster holds 
+    // about as many (uncompressed) bytes as requested, or 30 Mbytes,
+    // which is the ROOT default.
+    double bytesPerEntry = (double)tree->GetTotBytes() / nentries;
+    double clusterBytes  = autoFlush_ < 0 ? -autoFlush_ : 30000000;
+    if ( autoFlush_ <= 0 && bytesPerEntry > 0 )
+      {
+	long entries = (long)(clusterBytes / bytesPerEntry);
+	if ( entries < nentries ) entries = nentries;
+	tree->FlushBaskets();
+	tree->SetAutoFlush(entries);
+      }
+    tree->OptimizeBaskets(basketMemory_ > 0 ? basketMemory_ : 10000000,
+			  1.1, "");
+
+    std::cout << "\t==> TheNtupleMaker tuned baskets after " 
+	      << nentries << " events: " 
+	      << tree->GetAutoFlush() << " events/cluster <=="
+	      << std::endl;
+  }
+
+  // Return indices of the triggers that match the given patterns (with *
+  // as a wildcard), in the order of the HLT menu.
+  // The matches are cached per (pattern, menu).
+  std::vector<unsigned int> matchTriggers(std::vector<std::string>& patterns)
+  {
+    std::vector<unsigned int> index;
+    for(size_t c=0; c < patterns.size(); c++)
+      {
+	std::string key = menuHash_ + "|" + patterns[c];
+	if ( triggerMatches_.find(key) == triggerMatches_.end() )
+	  {
+	    if ( triggerRegex_.find(patterns[c]) == triggerRegex_.end() )
+	      {
+		std::string regex = kit::replace(patterns[c], "*", ".*");
+		regex = kit::replace(regex, "..*", ".*");
+		triggerRegex_[patterns[c]] = boost::regex(regex);
+	      }
+	    boost::regex& getname = triggerRegex_[patterns[c]];
+	    boost::smatch matchname;
+	    std::vector<unsigned int>& matches = triggerMatches_[key];
+	    for(unsigned int i=0; i < triggerNames_.size(); i++)
+	      if ( boost::regex_search(triggerNames_[i], matchname, getname) )
+		matches.push_back(i);
+	  }
+
+	std::vector<unsigned int>& matches = triggerMatches_[key];
+	for(size_t k=0; k < matches.size(); k++)
+	  if ( std::find(index.begin(), index.end(), matches[k]) 
+	       == index.end() )
+	    index.push_back(matches[k]);
+      }
+    std::sort(index.begin(), index.end());
+    return index;
+  }
+
+  // Resolve the triggers to be stored as bits to indices into 
+  // edm::TriggerResults.
+  void indexTriggers()
+  {
+    std::vector<unsigned int> index = matchTriggers(triggerPatterns_);
+    triggerTable_.clear();
+    for(size_t k=0; k < index.size(); k++) 
+      triggerTable_.push_back(triggerNames_[index[k]]);
+    triggerBuffer_->setTriggers(index);
+  }
+
+  // Write the prescales of the current lumi section. This is done for the
+  // first event of each lumi section since the prescale set is found from
+  // the event.
+  void refreshPrescales(const edm::Event& event, 
+			const edm::EventSetup& eventsetup)
+  {
+    int set = -1;
+    try
+      {
+	set = prescaleProvider_->prescaleSet(event, eventsetup);
+      }
+    catch (...)
+      {
+	set = -1;
+      }
+
+    prescaleValues_.assign(prescaleNames_.size(), -1);
+    if ( set >= 0 )
+      {
+	const HLTConfigProvider& hlt = prescaleProvider_->hltConfigProvider();
+	for(size_t c=0; c < prescaleNames_.size(); c++)
+	  prescaleValues_[c] = hlt.prescaleValue<double>(set, 
+							 prescaleNames_[c]);
+      }
+
+    prescaleRun_  = event.id().run();
+    prescaleLumi_ = event.luminosityBlock();
+    prescaleTree_->Fill();
+  }
+
+  // Append the trigger names of a new menu to the trigger names file,
+  // unless the file already lists the menu. The menu is written with a 
+  // single append so that jobs sharing the file do not overwrite each
+  // other.
+  void updateTriggerNamesFile(const MenuRecord& record)
+  {
+    std::string header("MENU HASH:     " + record.hash);
+    std::ifstream fin("triggerNames.txt");
+    std::string line;
+    while ( getline(fin, line) )
+      if ( line == header ) return;
+    fin.close();
+
+    std::ostringstream os;
+    os << header << std::endl;
+    os << "MENU TABLE:    " << record.table << std::endl;
+    os << "TRIGGER COUNT: " << record.names.size() << std::endl;
+    for(size_t i=0; i < record.names.size(); i++)
+      os << "\t" << record.names[i] << std::endl;
+    std::string text = os.str();
+
+    int fd = open("triggerNames.txt", O_WRONLY | O_CREAT | O_APPEND, 0644);
+    if ( fd < 0 ||
+	 write(fd, text.c_str(), text.size()) != (ssize_t)text.size() )
+      edm::LogWarning("TriggerNamesFileFailure")
+	<< "unable to append menu " << record.hash 
+	<< " to triggerNames.txt" << std::endl;
+    if ( fd >= 0 ) close(fd);
+  }
+
+  // Replace each name in the event filter expression by v[k], where k is
+  // the position of the name in names. Function names, namespace 
+  // qualified names, numbers and string literals are left as is.
+  std::string filterExpression(std::string expr, 
+			       std::vector<std::string>& names)
+  {
+    std::string out("");
+    size_t i = 0;
+    while ( i < expr.size() )
+      {
+	char c = expr[i];
+	if ( c == '"' || c == '\'' )
+	  {
+	    size_t j = expr.find(c, i+1);
+	    if ( j == std::string::npos ) j = expr.size()-1;
+	    out += expr.substr(i, j-i+1);
+	    i = j+1;
+	  }
+	else if ( std::isdigit(c) )
+	  {
+	    size_t j = i;
+	    while ( j < expr.size() && 
+		    (std::isalnum(expr[j]) || expr[j] == '.') ) j++;
+	    out += expr.substr(i, j-i);
+	    i = j;
+	  }
+	else if ( std::isalpha(c) || c == '_' )
+	  {
+	    size_t j = i;
+	    while ( j < expr.size() && 
+		    (std::isalnum(expr[j]) || expr[j] == '_' || 
+		     expr[j] == '.') ) j++;
+	    std::string name = expr.substr(i, j-i);
+	    size_t k = j;
+	    while ( k < expr.size() && expr[k] == ' ' ) k++;
+	    bool qualified = 
+	      (k < expr.size() && (expr[k] == '(' || expr[k] == ':')) ||
+	      (i > 0 && expr[i-1] == ':');
+	    if ( qualified || name == "true" || name == "false" || 
+		 name == "and" || name == "or" || name == "not" )
+	      out += name;
+	    else
+	      {
+		int index = std::find(names.begin(), names.end(), name)
+		  - names.begin();
+		if ( index == (int)names.size() ) names.push_back(name);
+		char v[40];
+		sprintf(v, "v[%d]", index);
+		out += std::string(v);
+	      }
+	    i = j;
+	  }
+	else
+	  {
+	    out += c;
+	    i++;
+	  }
+      }
+    return out;
+  }
+
+  // Return true if the trigger name matches one of the triggerBits 
+  // patterns, ignoring the version suffix of the pattern.
+  bool isTriggerBit(std::string name)
+  {
+    for(size_t c=0; c < triggerPatterns_.size(); c++)
+      {
+	std::string pattern = triggerPatterns_[c];
+	while ( pattern.size() > 0 && pattern[pattern.size()-1] == '*' )
+	  pattern = pattern.substr(0, pattern.size()-1);
+	if ( pattern.size() > 2 && pattern.substr(pattern.size()-2) == "_v" )
+	  pattern = pattern.substr(0, pattern.size()-2);
+	std::string regex = kit::replace(pattern, "*", ".*");
+	if ( boost::regex_search(name, boost::regex(regex)) ) return true;
+      }
+    return false;
+  }
+
+  // Resolve the names of the event filter, compile the filter and split
+  // the buffers into those needed by the filter and the rest.
+  void compileFilter()
+  {
+    std::vector<std::string> names;
+    std::string expr = filterExpression(eventFilter_, names);
+
+    for(size_t k=0; k < names.size(); k++)
+      {
+	FilterOperand op;
+	op.name     = names[k];
+	op.buffer   = 0;
+	op.variable = 0;
+	op.bit      = -1;
+	BufferThing* needed = 0;
+	std::string prefix = names[k].substr(0, names[k].find("."));
+	if ( names[k][0] == 'n' && 
+	     buffermap.find(names[k].substr(1)) != buffermap.end() )
+	  {
+	    op.buffer = buffermap[names[k].substr(1)];
+	    needed = op.buffer;
+	  }
+	else if ( variablemap.find(names[k]) != variablemap.end() &&
+		  variablemap[names[k]]->maxcount == 1 &&
+		  buffermap.find(prefix) != buffermap.end() )
+	  {
+	    op.variable = variablemap[names[k]];
+	    needed = buffermap[prefix];
+	  }
+	else if ( triggerBuffer_ && isTriggerBit(names[k]) )
+	  needed = triggerBuffer_;
+	else
+	  // Have a tantrum!
+	  throw edm::Exception(edm::errors::Configuration,
+			       "cfg error: " + BOLDRED +
+			       "eventFilter: " + names[k] + 
+			       " is not a count, a singleton variable "
+			       "or a trigger stored with triggerBits" 
+			       + DEFAULT_COLOR);
+	filterOperands_.push_back(op);
+	if ( std::find(filterBuffers_.begin(), filterBuffers_.end(), needed)
+	     == filterBuffers_.end() )
+	  filterBuffers_.push_back(needed);
+      }
+
+    otherBuffers_.clear();
+    for(size_t i=0; i < buffers.size(); i++)
+      if ( std::find(filterBuffers_.begin(), filterBuffers_.end(), 
+		     buffers[i]) == filterBuffers_.end() )
+	otherBuffers_.push_back(buffers[i]);
+
+    // The name of the filter function is unique so that several modules
+    // in the same job can each have a filter.
+    static int filterCount = 0;
+    std::string name = Form("tnm_event_filter_%s_%d", 
+			    tnm_hash(expr).c_str(), filterCount++);
+    std::string code = 
+      "extern \"C\" bool " + name + "(const double* v)\n"
+      "{\n  return " + expr + ";\n}\n";
+    if ( ! gInterpreter->Declare(code.c_str()) )
+      // Have a tantrum!
+      throw edm::Exception(edm::errors::Configuration,
+			   "cfg error: " + BOLDRED +
+			   "unable to compile eventFilter: " + eventFilter_ 
+			   + DEFAULT_COLOR);
+    long unsigned int address = 0;
+    gROOT->ProcessLine(Form("*(long unsigned int*)0x%lx = "
+			    "(long unsigned int)&%s;",
+			    (long unsigned int)&address, name.c_str()));
+    filter_ = (bool (*)(const double*))address;
+    filterValues_.assign(filterOperands_.size()+1, 0);
+  }
+
+  // Resolve the triggers of the event filter to bits of the trigger buffer.
+  // A name matches a trigger either exactly or up to its version suffix.
+  void indexFilterTriggers()
+  {
+    for(size_t k=0; k < filterOperands_.size(); k++)
+      {
+	FilterOperand& op = filterOperands_[k];
+	if ( op.buffer || op.variable ) continue;
+	op.bit = -1;
+	for(size_t c=0; c < triggerTable_.size(); c++)
+	  if ( triggerTable_[c] == op.name || 
+	       triggerTable_[c].find(op.name + "_v") == 0 )
+	    {
+	      op.bit = c;
+	      break;
+	    }
+	if ( op.bit < 0 )
+	  edm::LogWarning("EventFilterTrigger")
+	    << "eventFilter: trigger " << op.name 
+	    << " is not in the HLT menu of run " << triggerRun_
+	    << "; it is taken to be false" << std::endl;
+      }
+  }
+
+  // Evaluate the event filter. The buffers it needs must have been called.
+  bool passFilter()
+  {
+    for(size_t k=0; k < filterOperands_.size(); k++)
+      {
+	FilterOperand& op = filterOperands_[k];
+	if ( op.buffer )
+	  filterValues_[k] = op.buffer->size();
+	else if ( op.variable )
+	  filterValues_[k] = op.variable->number();
+	else
+	  filterValues_[k] = op.bit >= 0 && triggerBuffer_->fired(op.bit);
+      }
+    return filter_(&filterValues_[0]);
+  }
+
+  // Return a number in [0, 1) that depends only on (run, lumi, event), so 
+  // that the same events are sampled however the input is split into jobs.
+  double eventHash(unsigned int run, unsigned int lumi, 
+		   unsigned long long event)
+  {
+    unsigned long long x = event;
+    x ^= ((unsigned long long)run << 32) ^ lumi;
+    // splitmix64 finalizer
+    x += 0x9e3779b97f4a7c15ULL;
+    x = (x ^ (x >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    x = (x ^ (x >> 27)) * 0x94d049bb133111ebULL;
+    x ^= x >> 31;
+    return (x >> 11) * (1.0 / 9007199254740992.0);
+  }
+
+  // Return true if the event is to be skipped by the pre-sampling.
+  bool skipEvent(const edm::Event& event)
+  {
+    seenCount_++;
+    fileEventCount_++;
+    if ( firstEventsPerFile_ > 0 && fileEventCount_ > firstEventsPerFile_ )
+      return true;
+    if ( sampleEvery_ > 1 && (seenCount_-1) % sampleEvery_ != 0 )
+      return true;
+    if ( sampleFraction_ < 1 && 
+	 eventHash(event.id().run(), 
+		   event.luminosityBlock(), 
+		   event.id().event()) >= sampleFraction_ )
+      return true;
+    return false;
+  }
+
+  // Call methods for the given buffers. The products are fetched serially
+  // on the module thread, since edm::Event is not safe for concurrent 
+  // gets. Then, if requested, the getters are called concurrently, but 
+  // only if every getter is called natively, that is, not through the 
+  // interpreter.
+  void getBuffers(std::vector<BufferThing*>& bufs, const edm::Event& event)
+  {
+    bool concurrent = (bool)arena_;
+    for(size_t i=0; i < bufs.size(); i++) 
+      {
+	bufs[i]->fetch(event);
+	if ( concurrent && ! bufs[i]->isNative() ) concurrent = false;
+      }
+
+    if ( concurrent )
+      arena_->execute([&]()
+		      {
+			tbb::parallel_for(size_t(0), bufs.size(),
+					  [&](size_t i)
+					  {
+					    bufs[i]->fill();
+					  });
+		      });
+    else
+      for(size_t i=0; i < bufs.size(); i++) bufs[i]->fill();
+  }
+
+  // append code most recently written by the JIT code writers
+  void appendJitCode(std::ofstream& fout)
+  {
+    std::string getter_code;
+    std::ifstream fin(".jit_code.cc");
+    while (getline(fin, getter_code))
+      {
+	fout << getter_code << std::endl;
+      }
+    fin.close();
+  }
 };
 // ---------------------------------------------------------------------------
 // ---------------------------------------------------------------------------
@@ -160,6 +710,9 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 
   DirectoryName = iConfig.getParameter<string>("@module_label");
 
+  // the output tree is written through TFileService
+  usesResource("TFileService");
+
   tree = fs->make<TTree>("Events", 
 			 string("created by TheNtupleMaker " 
 				+ TNM_VERSION).c_str());
@@ -191,10 +744,6 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 
   if ( config != "" ) ptree_->Branch("cfg", (void*)(config.c_str()), "cfg/C");
 
-  // Ok, fill this branch
-  file->cd();
-  ptree_->Fill();
-
   // --------------------------------------------------------------------------
   // Cache global configuration
   Configuration::instance().set(iConfig);
@@ -211,6 +760,61 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
       triggerResults_ = edm::InputTag("TriggerResults", "", "HLT");
     }
 
+  // Catalogue of the HLT menus seen in the job, one entry per menu
+  mtree_ = new TTree("TriggerMenus",
+		     string("created by TheNtupleMaker " 
+			    + TNM_VERSION).c_str());
+  mtree_->Branch("hash",     &menuRecord_.hash);
+  mtree_->Branch("table",    &menuRecord_.table);
+  mtree_->Branch("firstRun", &menuRecord_.firstRun, "firstRun/i");
+  mtree_->Branch("lastRun",  &menuRecord_.lastRun,  "lastRun/i");
+  mtree_->Branch("names",    &menuRecord_.names);
+
+  // Triggers (with * as a wildcard) whose decisions are to be stored as
+  // the bits of the branch triggerBits. The name of the trigger of each
+  // bit is given, per run, in the tree Triggers.
+  try
+    {
+      triggerPatterns_ = iConfig.
+	getUntrackedParameter<vector<string> >("triggerBits");
+    }
+  catch (...)
+    {
+      triggerPatterns_.clear();
+    }
+  if ( triggerPatterns_.size() > 0 )
+    {
+      ttree_ = new TTree("Triggers",
+			 string("created by TheNtupleMaker " 
+				+ TNM_VERSION).c_str());
+      ttree_->Branch("run", &triggerRun_, "run/i");
+      ttree_->Branch("names", &triggerTable_);
+    }
+
+  // If true, write the prescales of the triggers of prescale methods and
+  // of the triggers stored as bits to the tree Prescales, once per lumi 
+  // section, rather than store them per event.
+  bool prescaleTree = false;
+  try
+    {
+      prescaleTree = iConfig.getUntrackedParameter<bool>("prescaleTree");
+    }
+  catch (...)
+    {
+      prescaleTree = false;
+    }
+  if ( prescaleTree )
+    {
+      prescalePatterns_ = triggerPatterns_;
+      prescaleTree_ = new TTree("Prescales",
+				string("created by TheNtupleMaker " 
+				       + TNM_VERSION).c_str());
+      prescaleTree_->Branch("run",    &prescaleRun_,  "run/i");
+      prescaleTree_->Branch("lumi",   &prescaleLumi_, "lumi/i");
+      prescaleTree_->Branch("names",  &prescaleNames_);
+      prescaleTree_->Branch("values", &prescaleValues_);
+    }
+
   try
     {
       imalivecount_ = iConfig.getUntrackedParameter<int>("imaliveCount");
@@ -218,16 +822,88 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
   catch (...)
     {}
 
-  // Save Tree header and branch buffers after every autosaveCount Mbytes
-  // have been written to file. Default is 100 Mbytes.
-  // int autosaveCount = 100;
-  // try
-  //   {
-  //     autosaveCount = iConfig.getUntrackedParameter<int>("autosaveCount");
-  //   }
-  // catch (...)
-  //   {}
-  //output.autosave(autosaveCount);
+  // Pre-sampling for quick-look ntuples. The modes can be combined, in
+  // which case an event must be selected by all of them.
+  try
+    {
+      sampleEvery_ = iConfig.getUntrackedParameter<int>("sampleEvery");
+    }
+  catch (...)
+    {
+      sampleEvery_ = 0;
+    }
+  try
+    {
+      sampleFraction_ = iConfig.
+	getUntrackedParameter<double>("sampleFraction");
+    }
+  catch (...)
+    {
+      sampleFraction_ = 1;
+    }
+  if ( sampleFraction_ <= 0 || sampleFraction_ > 1 )
+    // Have a tantrum!
+    throw edm::Exception(edm::errors::Configuration,
+			 "cfg error: " + BOLDRED +
+			 "sampleFraction must be in (0, 1]" + DEFAULT_COLOR);
+  try
+    {
+      firstEventsPerFile_ = iConfig.
+	getUntrackedParameter<int>("firstEventsPerFile");
+    }
+  catch (...)
+    {
+      firstEventsPerFile_ = 0;
+    }
+  if ( sampleEvery_ > 1 )
+    cout << "\t==> TheNtupleMaker will keep one in every " << sampleEvery_ 
+	 << " events <==" << endl;
+  if ( sampleFraction_ < 1 )
+    cout << "\t==> TheNtupleMaker will keep a fraction " << sampleFraction_
+	 << " of events <==" << endl;
+  if ( firstEventsPerFile_ > 0 )
+    cout << "\t==> TheNtupleMaker will keep the first " 
+	 << firstEventsPerFile_ << " events per file <==" << endl;
+
+  // Flush branch buffers (baskets) to file, thereby defining a cluster, 
+  // and save the tree header. As for TTree::SetAutoFlush and 
+  // TTree::SetAutoSave, a positive value is a number of entries and a 
+  // negative value a number of bytes. Zero means the ROOT default.
+  try
+    {
+      autoFlush_ = iConfig.getUntrackedParameter<int>("autoFlush");
+    }
+  catch (...)
+    {}
+  if ( autoFlush_ != 0 ) tree->SetAutoFlush(autoFlush_);
+
+  try
+    {
+      long autoSave = iConfig.getUntrackedParameter<int>("autoSave");
+      if ( autoSave != 0 ) tree->SetAutoSave(autoSave);
+    }
+  catch (...)
+    {}
+
+  // Total memory (in Mbytes) for the baskets of all branches. If given,
+  // the basket sizes are optimized within that budget after 
+  // autoTuneEvents events (1000 by default).
+  try
+    {
+      basketMemory_ = 1000000L * 
+	iConfig.getUntrackedParameter<int>("basketMemory");
+    }
+  catch (...)
+    {}
+
+  // If greater than zero, measure the first autoTuneEvents events, then
+  // choose the basket sizes and the cluster size.
+  try
+    {
+      autoTuneEvents_ = iConfig.getUntrackedParameter<int>("autoTuneEvents");
+    }
+  catch (...)
+    {}
 
   try
     {
@@ -269,6 +945,170 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
       includeLabel_ = true;
     }
 
+  // If true, compile a single getter per buffer rather than one getter 
+  // per variable. The fused getter walks the collection once per event.
+  try
+    {
+      fuseGetters_ = iConfig.
+	getUntrackedParameter<bool>("fuseGetters");
+    }
+  catch (...)
+    {
+      fuseGetters_ = false;
+    }
+  if ( fuseGetters_ )
+    cout << "\t==> TheNtupleMaker will use one getter per buffer <==" 
+	 << endl;
+
+  // Getters can be called either directly through a function pointer 
+  // (native) or through the interpreter (interpreter). The latter is
+  // slower, but is retained as a fallback.
+  try
+    {
+      getterMode_ = iConfig.
+	getUntrackedParameter<string>("getterMode");
+    }
+  catch (...)
+    {
+      getterMode_ = "native";
+    }
+  if ( getterMode_ != "native" && getterMode_ != "interpreter" )
+    // Have a tantrum!
+    throw edm::Exception(edm::errors::Configuration,
+			 "cfg error: " + BOLDRED +
+			 "getterMode must be native or interpreter, not " 
+			 + getterMode_ + DEFAULT_COLOR);
+  cout << "\t==> TheNtupleMaker getter mode: " << getterMode_ << " <==" 
+       << endl;
+
+  // Optional cache of compiled getter libraries, which can be re-used 
+  // by later jobs. The maximum size of the cache is in Mbytes.
+  string getterCache("");
+  int getterCacheSize = 500;
+  try
+    {
+      getterCache = iConfig.getUntrackedParameter<string>("getterCache");
+    }
+  catch (...)
+    {}
+  try
+    {
+      getterCacheSize = iConfig.getUntrackedParameter<int>("getterCacheSize");
+    }
+  catch (...)
+    {}
+  tnm_set_getter_cache(getterCache, getterCacheSize);
+  if ( tnm_getter_cache() != "" )
+    cout << "\t==> TheNtupleMaker getter cache: " << tnm_getter_cache() 
+	 << " <==" << endl;
+
+  // If true, assemble the code for all buffers, variables and getters
+  // into a single translation unit and declare it to the JIT compiler 
+  // in one go.
+  try
+    {
+      jitBatch_ = iConfig.getUntrackedParameter<bool>("jitBatch");
+    }
+  catch (...)
+    {
+      jitBatch_ = false;
+    }
+
+  // If true, compile the getters of a buffer only when its product is
+  // first found. The branches are nevertheless created up front.
+  try
+    {
+      lazyJit_ = iConfig.getUntrackedParameter<bool>("lazyJit");
+    }
+  catch (...)
+    {
+      lazyJit_ = false;
+    }
+  if ( lazyJit_ )
+    cout << "\t==> TheNtupleMaker will compile getters on demand <==" 
+	 << endl;
+
+  // If true, a product missing from the first event of an input file is
+  // not looked for again until the next file is opened. This is off by
+  // default since a product may be present in some events of a file but
+  // not in others. Turn it on only if every product is either in every
+  // event of a file or in none.
+  try
+    {
+      skipMissingProducts_ = iConfig.
+	getUntrackedParameter<bool>("skipMissingProducts");
+    }
+  catch (...)
+    {
+      skipMissingProducts_ = false;
+    }
+
+  // If true, store each collection as a counter branch n<prefix> and a
+  // variable-length array <prefix>_<variable>[n<prefix>] per variable,
+  // rather than as one vector branch per variable.
+  try
+    {
+      arrayLayout_ = iConfig.getUntrackedParameter<bool>("arrayLayout");
+    }
+  catch (...)
+    {
+      arrayLayout_ = false;
+    }
+  if ( arrayLayout_ )
+    cout << "\t==> TheNtupleMaker will store collections as arrays <==" 
+	 << endl;
+
+  // If true, store each collection variable of type vector<T> (including 
+  // a product of type vector<vector<T> >, where T is a simple type) as a 
+  // flat vector<T> branch <name> holding the values of all objects and a
+  // vector<int> branch <name>_offsets. The values of object c are at
+  // positions offsets[c] to offsets[c+1]-1.
+  try
+    {
+      flattenNested_ = iConfig.getUntrackedParameter<bool>("flattenNested");
+    }
+  catch (...)
+    {
+      flattenNested_ = false;
+    }
+  if ( flattenNested_ )
+    cout << "\t==> TheNtupleMaker will flatten nested vectors <==" 
+	 << endl;
+
+  // If greater than zero, evaluate the buffers of an event concurrently
+  // using a task arena with the given maximum number of threads. The
+  // products are fetched serially, then the getters, which fill different
+  // branches, are called concurrently. The getters must be called natively
+  // and compiled up front, because the interpreter is not thread-safe; if
+  // any getter falls back to the interpreter, the buffers are filled 
+  // serially.
+  try
+    {
+      parallelBuffers_ = iConfig.
+	getUntrackedParameter<int>("parallelBuffers");
+    }
+  catch (...)
+    {
+      parallelBuffers_ = 0;
+    }
+  if ( parallelBuffers_ > 0 )
+    {
+      if ( getterMode_ != "native" || lazyJit_ )
+	{
+	  edm::LogWarning("ParallelBuffersDisabled")
+	    << "parallelBuffers requires getterMode = native "
+	    << "and lazyJit = False; buffers will be evaluated serially"
+	    << std::endl;
+	  parallelBuffers_ = 0;
+	}
+      else
+	{
+	  arena_.reset(new tbb::task_arena(parallelBuffers_));
+	  cout << "\t==> TheNtupleMaker will evaluate buffers using " 
+	       << parallelBuffers_ << " threads <==" 
+	       << endl;
+	}
+    }
   
   // --------------------------------------------------------------------------
 
@@ -333,6 +1173,32 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
   // Helper methods may optionally contain strings with the format
   //   parameter parameter-name = parameter-value
   //
+  // A collection may be given a cut, e.g.,
+  //   param cut = pt() > 20 && abs(eta()) < 2.5
+  // in which case only objects that pass the cut are stored. The cut is 
+  // evaluated once per object before any method is called. Unqualified 
+  // calls, other than to math functions, are calls of the object.
+  //
+  // A block may define derived variables, computed in-job, e.g.,
+  //   expr double p = pt()*cosh(eta())
+  //   expr float  dphi = kit::deltaPhi(phi, 1.5)
+  // The expression may use the variables of the block listed before it,
+  // by their names in the ntuple, unqualified calls of the object, math 
+  // functions and functions in namespace kit. The derived variables are
+  // computed by the fused getter of the block.
+  //
+  // A method may end with a storage annotation
+  //   as <type>
+  // where <type> is
+  //   float, double, char, short, int, long, bool, uchar, ushort, uint,
+  //   float:<bits>  - float rounded to <bits> mantissa bits (1 to 22)
+  //   float16       - same as float:10
+  //   bit           - bool packed, with the other flags of the block, into
+  //                   the bits of the <prefix>.flags branch. The decoding
+  //                   table is stored in the Provenance tree.
+  //
+  // className may be a vector of a simple type, in which case a product
+  // of type vector<vector<T> > is read if maxcount > 1.
   // --------------------------------------------------------------------------
 
   // We need several regular expressions for decoding
@@ -342,6 +1208,9 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
   boost::regex  getparam("^ *param +");
   boost::smatch matchparam;
 
+  boost::regex  getexpr("^ *expr +(.+?) +([a-zA-Z_][a-zA-Z0-9_]*) *= *(.+)$");
+  boost::smatch matchexpr;
+
   boost::regex  getvarprefix("(?<=/)[a-zA-Z0-9]+");
   boost::smatch matchvarprefix;
 
@@ -356,18 +1225,14 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 
   boost::regex  getnspace("^(edm|reco|pat|l1extra|trigger)");
   boost::smatch matchnspace;
+
+  boost::regex  getstorage("[ ]+as[ ]+([a-zA-Z0-9_:]+)[ ]*$");
+  boost::smatch matchstorage;
   // --------------------------------------------------------------------------
   // get list of strings from buffer, decode them, and cache the results
   // NOTE: within TNM, block and buffer are used interchangeably
   // --------------------------------------------------------------------------
 
-  std::vector<std::string> className_;
-  std::vector<std::string> blockName_;
-  std::vector<std::string> bufferName_;
-  std::vector<std::string> label_;
-  std::vector<std::string> prefix_;
-  std::vector<int> maxcount_;
-
   vector<string> vrecords = iConfig.
     getUntrackedParameter<vector<string> >("buffers");
 
@@ -427,6 +1292,20 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
       bool simpletype = boost::regex_search(bufferName_lower, 
 					    matchtype, getsimpletype);
 
+      // a vector of a simple type is also a simple type. if maxcount > 1,
+      // the product is a vector<vector<T> >
+      boost::regex getnestedtype("^(std::)?vector<[ ]*((unsigned )?"
+				 "(float|double|int|long|size_t|short"
+				 "|bool|char))[ ]*>$");
+      boost::smatch matchnested;
+      bool nestedtype = boost::regex_search(className, matchnested, 
+					    getnestedtype);
+      if ( nestedtype )
+	{
+	  className  = string("std::vector<") + matchnested[2] + string(">");
+	  simpletype = true;
+	}
+
       // ----------------------------------------------------------------
       // In the ROOT 5 version of TNM, the bufferName is given, not 
       // the className, so we need to extract the className from the 
@@ -544,7 +1423,11 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 
       std::map<std::string, std::string> parameters;
 
-     if ( simpletype )
+     if ( nestedtype )
+	{
+	  var.push_back(VariableDescriptor(className, "", ""));
+	}
+     else if ( simpletype )
 	{
 	  var.push_back(VariableDescriptor(bufferName, "", ""));
 	}
@@ -567,14 +1450,39 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 		{
 		  std::string param = kit::replace(record,
 						   matchparam[0], "");
+		  // split at the first "=" since the value, e.g., a cut,
+		  // may contain "=" 
 		  string key, value;
-		  kit::bisplit(param, key, value, "=");
+		  kit::bisplit(param, key, value, "=", -1);
 		  key   = kit::strip(key);
 		  value = kit::strip(value);
 		  parameters[key] = value;
 		  continue;
 		}
 
+	      // Check for a derived variable. Its method is the expression
+	      // prefixed by "=", which is translated once the names of the
+	      // variables are known.
+	      if ( boost::regex_search(record, matchexpr, getexpr) )
+		{
+		  var.push_back(VariableDescriptor(kit::strip(matchexpr[1]),
+						   "=" + 
+						   kit::strip(matchexpr[3]),
+						   matchexpr[2]));
+		  continue;
+		}
+
+	      // Check for a storage annotation
+	      string rstorage("");
+	      int  bits   = 0;
+	      bool packed = false;
+	      if ( boost::regex_search(record, matchstorage, getstorage) )
+		{
+		  decodeStorage(matchstorage[1], blockName + ": " + record,
+				rstorage, bits, packed);
+		  record = record.substr(0, matchstorage.position(0));
+		}
+
 	      // Get method
 	      if ( ! boost::regex_search(record, matchmethod, getmethod) ) 
 		// Throw another tantrum!
@@ -603,7 +1511,10 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 		{
 		  varname = matchstrarg[0];
 		  if ( method.substr(0,8) == "prescale" )
-		    varname = "prescale" + varname;
+		    {
+		      varname = "prescale" + varname;
+		      prescalePatterns_.push_back(matchstrarg[0]);
+		    }
 		}
 
 	      // Check for an alias
@@ -614,6 +1525,7 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 	      kit::bisplit(record, left, right, method);
 
 	      string rtype = kit::strip(left);
+	      if ( rstorage != "" ) rtype = rstorage;
 	      right = kit::strip(right);
 	      if ( right != "" )  varname = right;
 
@@ -654,7 +1566,8 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 		{
 		  // No range variable detected so just
 		  // add to vector of variables
-		  var.push_back(VariableDescriptor(rtype, method, varname));
+		  var.push_back(VariableDescriptor(rtype, method, varname,
+						   bits, packed));
               
 		  if ( DEBUG > 0 )
 		    cout << "   rtype:   " << BOLDRED   << rtype 
@@ -688,7 +1601,8 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 		      varname = vname + number; // update varname
 
 		      // Add to vector of variables
-		      var.push_back(VariableDescriptor(rtype, method, varname));
+		      var.push_back(VariableDescriptor(rtype, method, varname,
+						       bits, packed));
                                                    
 		      if ( DEBUG > 0 )
 			cout << "   rtype:   " << RED   << rtype 
@@ -713,6 +1627,25 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
       prefix_.push_back(prefix);
       variables_.push_back(var);
       maxcount_.push_back(maxcount);
+      simpletype_.push_back(simpletype);
+
+      // object selection (collections only)
+      string cut("");
+      if ( parameters.find("cut") != parameters.end() )
+	{
+	  if ( maxcount > 1 )
+	    cut = parameters["cut"];
+	  else
+	    edm::LogWarning("CutIgnored")
+	      << "a cut applies only to a collection; ignored for " 
+	      << blockName << std::endl;
+	}
+      cut_.push_back(cut);
+
+      bool derived = false;
+      for(size_t jj=0; jj < var.size(); jj++)
+	if ( var[jj].method.substr(0, 1) == "=" ) derived = true;
+      derived_.push_back(derived);
     }
 
   // ---------------------------------------------------------------
@@ -744,6 +1677,27 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 		      branchcount);
   vout.close();
 
+  // Translate derived expressions into code for the fused getters. A name
+  // in an expression refers to a preceding variable of the block.
+  for(size_t ii=0; ii < blockName_.size(); ii++)
+    {
+      if ( ! derived_[ii] ) continue;
+      vector<string> names;
+      for(size_t jj=0; jj < variables_[ii].size(); jj++)
+	{
+	  VariableDescriptor& v = variables_[ii][jj];
+	  if ( v.method.substr(0, 1) == "=" )
+	    {
+	      v.method = "=" + tnm_derived_expression(v.method.substr(1), 
+						      names);
+	      if ( DEBUG > 0 )
+		cout << "   derived: " << BOLDGREEN << v.branchname 
+		     << DEFAULT_COLOR << " = " << v.method.substr(1) << endl;
+	    }
+	  names.push_back(v.branchname.substr(v.branchname.find(".")+1));
+	}
+    }
+
   // --------------------------------------------------------------
   // Create ntuple analyzer template if requested
   // --------------------------------------------------------------
@@ -755,20 +1709,278 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
   //   }
   
   // ---------------------------------------------------------------
-  // Compile TheNtupleMaker header
+  // Compile buffers, variables and getters and save the generated
+  // code to jit_code.cc
   // ---------------------------------------------------------------
   ofstream fout("jit_code.cc");
 
-  char code[8000];
-  sprintf(code,
-	  "#include \"PhysicsTools/TheNtupleMaker/interface/"
-	  "TheNtupleMaker.h\"\n");
-
   fout << "// ------------------------------------------------" 
        << "---------------" << endl;
   fout << "// Created: TheNtupleMaker " << ct;
   fout << "// ------------------------------------------------"	
        << "---------------" << endl;
+
+  if ( jitBatch_ )
+    declareBuffers(fout);
+  else
+    compileBuffers(fout);
+
+  fout.close();
+
+  // --------------------------------------------------------------------------
+  // Add trigger buffer. Its triggers are resolved in beginRun
+  // --------------------------------------------------------------------------
+  if ( triggerPatterns_.size() > 0 )
+    {
+      triggerBuffer_ = new TriggerBuffer("triggerBits", triggerResults_);
+      triggerBuffer_->init(this, "");
+      buffers.push_back(triggerBuffer_);
+    }
+
+  // --------------------------------------------------------------------------
+  // Optional event filter. The buffers it needs are called first and the
+  // remaining buffers only if the event passes.
+  // --------------------------------------------------------------------------
+  try
+    {
+      eventFilter_ = iConfig.getUntrackedParameter<string>("eventFilter");
+    }
+  catch (...)
+    {
+      eventFilter_ = "";
+    }
+  otherBuffers_ = buffers;
+  if ( eventFilter_ != "" )
+    {
+      compileFilter();
+      cout << "\t==> TheNtupleMaker event filter: " << eventFilter_ 
+	   << " <==" << endl;
+    }
+
+  // --------------------------------------------------------------------------
+  // If the tree Prescales is requested, the prescales of the triggers of
+  // prescale methods and of the triggers stored as bits are found once
+  // per lumi section and written to the tree. Otherwise, no 
+  // HLTPrescaleProvider is created. The optional parameter set 
+  // prescaleProvider configures the HLTPrescaleProvider.
+  // --------------------------------------------------------------------------
+  if ( prescaleTree_ && prescalePatterns_.size() > 0 )
+    {
+      edm::ParameterSet pset;
+      try
+	{
+	  pset = iConfig.getParameter<edm::ParameterSet>("prescaleProvider");
+	}
+      catch (...)
+	{
+	  pset.addParameter<unsigned int>("stageL1Trigger", 2);
+	  pset.addParameter<edm::InputTag>("l1tAlgBlkInputTag", 
+					   edm::InputTag("gtStage2Digis"));
+	  pset.addParameter<edm::InputTag>("l1tExtBlkInputTag", 
+					   edm::InputTag("gtStage2Digis"));
+	}
+      prescaleProvider_ = std::unique_ptr<HLTPrescaleProvider>
+	(new HLTPrescaleProvider(pset, consumesCollector(), *this));
+    }
+
+  // --------------------------------------------------------------------------
+  // Now that all branches exist, set their compression and basket sizes
+  // --------------------------------------------------------------------------
+  configureBranches(iConfig);
+
+  // --------------------------------------------------------------------------
+  // Add decoding table of packed flags to provenance tree, one line per flag
+  //   <flags branch> <bit> <branch name of flag>
+  // then fill the provenance tree
+  // --------------------------------------------------------------------------
+  string flagtable("");
+  for(size_t ii=0; ii < variables_.size(); ii++)
+    {
+      int bit = 0;
+      for(size_t jj=0; jj < variables_[ii].size(); jj++)
+	{
+	  VariableDescriptor& v = variables_[ii][jj];
+	  if ( ! v.packed ) continue;
+	  char number[80];
+	  sprintf(number, " %d ", bit);
+	  string flagname = tnm_flag_branchname(v.branchname);
+	  if ( arrayLayout_ && v.maxcount > 1 ) 
+	    flagname = tnm_array_branchname(flagname);
+	  flagtable += flagname + number + v.branchname + "\n";
+	  bit++;
+	}
+    }
+  if ( flagtable != "" ) 
+    ptree_->Branch("flags", (void*)(flagtable.c_str()), "flags/C");
+
+  // Ok, fill the provenance tree
+  file->cd();
+  ptree_->Fill();
+
+  // // Check for crash switch
+  
+  // bool crash = false;
+  // try
+  //   {
+  //     crash = 
+  //       (bool)Configuration::instance().
+  //       getConfig()->getUntrackedParameter<int>("crashOnInvalidHandle");
+  //   }
+  // catch (...)
+  //   {}
+
+  // if ( crash )
+  //   cout << "\t==> TheNtupleMaker will CRASH if a handle is invalid <==";
+  // else
+  //   cout << "\t==> TheNtupleMaker will WARN if a product is not found <==";
+  // cout << endl << endl;
+
+  cout << endl << "END TheNtupleMaker Configuration" 
+       << endl << endl;
+}
+
+
+// Set compression and basket sizes of the branches of the output tree.
+void
+TheNtupleMaker::configureBranches(const edm::ParameterSet& iConfig)
+{
+  // Compression algorithm (ZLIB, LZMA, LZ4 or ZSTD) and level. If the
+  // level is not given, the level recommended by ROOT for the algorithm 
+  // is used.
+  string algorithm("");
+  int level = -1;
+  try
+    {
+      algorithm = iConfig.
+	getUntrackedParameter<string>("compressionAlgorithm");
+    }
+  catch (...)
+    {}
+  try
+    {
+      level = iConfig.getUntrackedParameter<int>("compressionLevel");
+    }
+  catch (...)
+    {}
+
+  if ( algorithm != "" || level > -1 )
+    {
+      boost::algorithm::to_upper(algorithm);
+      ROOT::RCompressionSetting::EAlgorithm::EValues alg = 
+	ROOT::RCompressionSetting::EAlgorithm::kUseGlobal;
+      int deflevel = 1;
+      if      ( algorithm == "ZLIB" )
+	{
+	  alg = ROOT::RCompressionSetting::EAlgorithm::kZLIB;
+	  deflevel = 1;
+	}
+      else if ( algorithm == "LZMA" )
+	{
+	  alg = ROOT::RCompressionSetting::EAlgorithm::kLZMA;
+	  deflevel = 7;
+	}
+      else if ( algorithm == "LZ4" )
+	{
+	  alg = ROOT::RCompressionSetting::EAlgorithm::kLZ4;
+	  deflevel = 4;
+	}
+      else if ( algorithm == "ZSTD" )
+	{
+	  alg = ROOT::RCompressionSetting::EAlgorithm::kZSTD;
+	  deflevel = 5;
+	}
+      else if ( algorithm != "" )
+	// Have a tantrum!
+	throw edm::Exception(edm::errors::Configuration,
+			     "cfg error: " + BOLDRED +
+			     "unknown compressionAlgorithm " + algorithm +
+			     " (use ZLIB, LZMA, LZ4 or ZSTD)"
+			     + DEFAULT_COLOR);
+      if ( level < 0 ) level = deflevel;
+
+      int settings = ROOT::CompressionSettings(alg, level);
+      TIter next(tree->GetListOfBranches());
+      while ( TBranch* branch = (TBranch*)next() ) 
+	branch->SetCompressionSettings(settings);
+      cout << "\t==> TheNtupleMaker compression: " 
+	   << algorithm << " level " << level << " <==" << endl;
+    }
+
+  // Default basket size (in bytes) of all branches
+  try
+    {
+      int basketSize = iConfig.getUntrackedParameter<int>("basketSize");
+      tree->SetBasketSize("*", basketSize);
+    }
+  catch (...)
+    {}
+
+  // Basket sizes of specific branches, given as
+  //   <branchname> <size>
+  // where the branch name can contain wildcards, e.g., "patJet_* 256000"
+  vector<string> basketSizes;
+  try
+    {
+      basketSizes = iConfig.
+	getUntrackedParameter<vector<string> >("basketSizes");
+    }
+  catch (...)
+    {}
+  for(size_t c=0; c < basketSizes.size(); c++)
+    {
+      vector<string> field;
+      kit::split(basketSizes[c], field);
+      if ( field.size() != 2 )
+	// Have a tantrum!
+	throw edm::Exception(edm::errors::Configuration,
+			     "cfg error: " + BOLDRED +
+			     "expected <branchname> <size> in basketSizes, "
+			     "but found " + basketSizes[c]
+			     + DEFAULT_COLOR);
+      tree->SetBasketSize(field[0].c_str(), atoi(field[1].c_str()));
+    }
+
+  // A memory budget is applied after the first 1000 events if the number 
+  // of events to measure is not given
+  if ( basketMemory_ > 0 && autoTuneEvents_ <= 0 ) autoTuneEvents_ = 1000;
+
+  // If true, compress the baskets of the tree concurrently using ROOT 
+  // implicit multi-threading, which is enabled by the framework when the 
+  // job runs with more than one thread. A tree takes its setting from
+  // ROOT when it is created, so the setting is applied explicitly, either
+  // way.
+  bool parallelFill = false;
+  try
+    {
+      parallelFill = iConfig.getUntrackedParameter<bool>("parallelFill");
+    }
+  catch (...)
+    {}
+  tree->SetImplicitMT(parallelFill);
+  if ( parallelFill )
+    {
+      if ( ROOT::IsImplicitMTEnabled() )
+	cout << "\t==> TheNtupleMaker will compress baskets concurrently <==" 
+	     << endl;
+      else
+	edm::LogWarning("ImplicitMTDisabled")
+	  << "ROOT implicit multi-threading is not enabled "
+	  << "(run with numberOfThreads > 1); baskets will be compressed "
+	  << "serially"
+	  << std::endl;
+    }
+}
+
+// Compile buffers, variables and getters one at a time.
+void
+TheNtupleMaker::compileBuffers(std::ofstream& fout)
+{
+  char code[8000];
+  sprintf(code,
+	  "#include \"PhysicsTools/TheNtupleMaker/interface/"
+	  "TheNtupleMaker.h\"\n"
+	  "#include \"PhysicsTools/TheNtupleMaker/interface/kit.h\"\n");
+
   fout << code;
   fout << "// ------------------------------------------------" 
        << "---------------" << endl;
@@ -794,7 +2006,21 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
     {
       cout << "compiling " << blockName_[ii] << endl;
 
-      if ( maxcount_[ii] > 1 )
+      // products of simple type are copied directly and need no getters
+      bool simple = simpletype_[ii];
+
+      // a buffer with a cut or derived variables must use a fused getter
+      bool fuse = fuseGetters_ || cut_[ii] != "" || derived_[ii];
+
+      if ( simple && maxcount_[ii] > 1 )
+	sprintf(code, 
+		"SimpleBuffer< std::vector<%s>, %s > \tbuffer%d;\n",
+		className_[ii].c_str(), className_[ii].c_str(), ii);
+      else if ( simple )
+	sprintf(code, 
+		"SimpleBuffer< %s, %s > \tbuffer%d;\n",
+		className_[ii].c_str(), className_[ii].c_str(), ii);
+      else if ( maxcount_[ii] > 1 )
 	sprintf(code, 
 		"Buffer< std::vector<%s> > \tbuffer%d;\n",
 		className_[ii].c_str(), ii);
@@ -822,19 +2048,21 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 	  
       // Cache buffer address
       buffers.push_back((BufferThing*)objectaddr);
+      buffermap[prefix_[ii]] = buffers.back();
       
       // Compile variables of current buffer
       BufferThing* pbuffer = buffers.back();
       for(int jj=0; jj < (int)variables_[ii].size(); jj++)
 	{
 	  sprintf(code, 
-		  "Variable< %s, %s > \tvar%d%d(\"%s\", %d, \"%s\");\n",
+		  "Variable< %s, %s > \tvar%d%d(\"%s\", %d, \"%s\", %s);\n",
 		  className_[ii].c_str(),
 		  variables_[ii][jj].rtype.c_str(),
 		  ii, jj,
 		  variables_[ii][jj].method.c_str(),
 		  maxcount_[ii],
-		  variables_[ii][jj].branchname.c_str());
+		  variables_[ii][jj].branchname.c_str(),
+		  fuse || lazyJit_ || simple ? "false" : "true");
 
 	  if ( DEBUG < 0 ) cout << "\t" 
 	       << CYAN << code 
@@ -844,13 +2072,7 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 	  gROOT->ProcessLine(code);
 
           // the getter code for current variable should be available
-	  string getter_code;
-          ifstream fin(".jit_code.cc");
-    	  while (getline(fin, getter_code))
-	   {
-              fout << getter_code << endl;
-	   }
-          fin.close();
+	  if ( ! fuse && ! lazyJit_ && ! simple ) appendJitCode(fout);
 
 	  sprintf(code, 
 		  "objectaddr  = (long unsigned int*)%s;\n"
@@ -860,35 +2082,276 @@ TheNtupleMaker::TheNtupleMaker(const edm::ParameterSet& iConfig)
 	  gROOT->ProcessLine(Form(code, &objectaddr));
 	      
 	  // Cache variable address in buffer
-	  pbuffer->add((VariableThing*)objectaddr);
+	  VariableThing* pvar = (VariableThing*)objectaddr;
+	  pvar->bits    = variables_[ii][jj].bits;
+	  pvar->packed  = variables_[ii][jj].packed;
+	  pvar->flatten = flattenNested_;
+	  pbuffer->add(pvar);
+	  variablemap[variables_[ii][jj].branchname] = pvar;
 	}
       
+      // Compile a single getter for all variables of current buffer
+      pbuffer->select(cut_[ii]);
+      if ( fuse && ! lazyJit_ && ! simple )
+	{
+	  pbuffer->fuse();
+	  appendJitCode(fout);
+	}
+
       // Now initialize buffer
+      pbuffer->useNative(getterMode_ == "native");
+      pbuffer->useArrays(arrayLayout_);
       pbuffer->init(this, label_[ii]);
+      if ( lazyJit_ ) pbuffer->defer(fuse);
     }
+}
 
-  fout.close();
+// Assemble the code for all buffers, variables and getters into a single
+// translation unit, declare it to the JIT compiler in one go, and then
+// retrieve the addresses of all objects with a single call.
+void
+TheNtupleMaker::declareBuffers(std::ofstream& fout)
+{
+  char record[8000];
 
-  // // Check for crash switch
-  
-  // bool crash = false;
-  // try
-  //   {
-  //     crash = 
-  //       (bool)Configuration::instance().
-  //       getConfig()->getUntrackedParameter<int>("crashOnInvalidHandle");
-  //   }
-  // catch (...)
-  //   {}
+  string code("#include \"PhysicsTools/TheNtupleMaker/interface/"
+	      "TheNtupleMaker.h\"\n"
+	      "#include \"PhysicsTools/TheNtupleMaker/interface/kit.h\"\n");
+  string regcode("");
 
-  // if ( crash )
-  //   cout << "\t==> TheNtupleMaker will CRASH if a handle is invalid <==";
-  // else
-  //   cout << "\t==> TheNtupleMaker will WARN if a product is not found <==";
-  // cout << endl << endl;
+  // getters, some of which may have been loaded from the getter cache
+  vector<string> gclass;
+  vector<long unsigned int> gaddr;
+  vector<long unsigned int> gfunc;
 
-  cout << endl << "END TheNtupleMaker Configuration" 
+  // index of getter associated with each buffer (if fused) and variable
+  vector<int> bgetter(blockName_.size(), -1);
+  vector<vector<int> > vgetter(blockName_.size());
+  int nvar = 0;
+
+  // identical getters are written once and shared
+  vector<string> gkey;
+  map<string, int> gindex;
+
+  for(int ii=0; ii < (int)blockName_.size(); ii++)
+    {
+      // products of simple type are copied directly and need no getters
+      bool simple = simpletype_[ii];
+
+      // a buffer with a cut or derived variables must use a fused getter
+      bool fuse = fuseGetters_ || cut_[ii] != "" || derived_[ii];
+
+      if ( simple && maxcount_[ii] > 1 )
+	sprintf(record, 
+		"\n// ====> BLOCK( %s )\n\n"
+		"SimpleBuffer< std::vector<%s>, %s > \tbuffer%d;\n",
+		blockName_[ii].c_str(), className_[ii].c_str(), 
+		className_[ii].c_str(), ii);
+      else if ( simple )
+	sprintf(record, 
+		"\n// ====> BLOCK( %s )\n\n"
+		"SimpleBuffer< %s, %s > \tbuffer%d;\n",
+		blockName_[ii].c_str(), className_[ii].c_str(), 
+		className_[ii].c_str(), ii);
+      else if ( maxcount_[ii] > 1 )
+	sprintf(record, 
+		"\n// ====> BLOCK( %s )\n\n"
+		"Buffer< std::vector<%s> > \tbuffer%d;\n",
+		blockName_[ii].c_str(), className_[ii].c_str(), ii);
+      else
+	sprintf(record, 
+		"\n// ====> BLOCK( %s )\n\n"
+		"Buffer< %s > \tbuffer%d;\n",
+		blockName_[ii].c_str(), className_[ii].c_str(), ii);
+      code += string(record);
+
+      sprintf(record, "  b[%d] = (long unsigned int)&buffer%d;\n", ii, ii);
+      regcode += string(record);
+
+      vector<VariableDescriptor>& var = variables_[ii];
+
+      // write getter struct(s) unless they are in the getter cache or
+      // are to be compiled on demand
+      vector<string> keys;
+      vector<string> classnames;
+      vector<string> structs;
+      if ( lazyJit_ || simple )
+	;
+      else if ( fuse )
+	{
+	  vector<string> methods;
+	  vector<string> rtypes;
+	  for(size_t jj=0; jj < var.size(); jj++)
+	    {
+	      methods.push_back(var[jj].method);
+	      rtypes.push_back(var[jj].rtype);
+	    }
+	  keys.push_back(tnm_fused_getter_key(className_[ii],
+					      rtypes,
+					      methods,
+					      maxcount_[ii],
+					      cut_[ii]));
+	  if ( tnm_getter_cache() != "" )
+	    classnames.push_back(tnm_getter_classname(keys.back()));
+	  else
+	    {
+	      sprintf(record, "FusedGetter%d", ii);
+	      classnames.push_back(string(record));
+	    }
+	  structs.push_back(tnm_write_fused_struct(classnames.back(),
+						   methods,
+						   className_[ii],
+						   rtypes,
+						   maxcount_[ii],
+						   cut_[ii]));
+	}
+      else
+	for(size_t jj=0; jj < var.size(); jj++)
+	  {
+	    keys.push_back(tnm_getter_key(className_[ii],
+					  var[jj].rtype,
+					  var[jj].method,
+					  maxcount_[ii]));
+	    if ( tnm_getter_cache() != "" )
+	      classnames.push_back(tnm_getter_classname(keys.back()));
+	    else
+	      {
+		sprintf(record, "Getter%d_%d", ii, (int)jj);
+		classnames.push_back(string(record));
+	      }
+	    structs.push_back(tnm_write_getter_struct(classnames.back(),
+						      var[jj].method,
+						      className_[ii],
+						      var[jj].rtype,
+						      maxcount_[ii]));
+	  }
+
+      for(size_t c=0; c < classnames.size(); c++)
+	{
+	  int k = (int)gclass.size();
+	  if ( gindex.find(keys[c]) != gindex.end() ) k = gindex[keys[c]];
+	  if ( fuse )
+	    bgetter[ii] = k;
+	  else
+	    vgetter[ii].push_back(k);
+	  if ( k < (int)gclass.size() ) continue;
+
+	  gindex[keys[c]] = k;
+	  gkey.push_back(keys[c]);
+	  gclass.push_back(classnames[c]);
+	  gaddr.push_back(0);
+	  gfunc.push_back(0);
+
+	  if ( tnm_load_cached_getter(classnames[c], structs[c], 
+				      className_[ii], gaddr[k], gfunc[k]) )
+	    continue;
+
+	  code += structs[c];
+	  code += tnm_write_trampoline_code(classnames[c],
+					    classnames[c] + "_instance");
+	  sprintf(record, 
+		  "  g[%d] = (long unsigned int)&%s_instance;\n"
+		  "  f[%d] = (long unsigned int)&%s_get;\n", 
+		  k, classnames[c].c_str(), k, classnames[c].c_str());
+	  regcode += string(record);
+	}
+
+      // variables get their getters from the buffer or from above
+      for(int jj=0; jj < (int)var.size(); jj++)
+	{
+	  sprintf(record, 
+		  "Variable< %s, %s > \tvar%d%d(\"%s\", %d, \"%s\", false);\n",
+		  className_[ii].c_str(),
+		  var[jj].rtype.c_str(),
+		  ii, jj,
+		  var[jj].method.c_str(),
+		  maxcount_[ii],
+		  var[jj].branchname.c_str());
+	  code += string(record);
+
+	  sprintf(record, "  v[%d] = (long unsigned int)&var%d%d;\n", 
+		  nvar, ii, jj);
+	  regcode += string(record);
+	  nvar++;
+	}
+    }
+
+  // function to return addresses of all objects
+  code += "\n// return addresses of buffers, variables and getters to TNM\n"
+    "extern \"C\" void tnm_register(long unsigned int* b,\n"
+    "                             long unsigned int* v,\n"
+    "                             long unsigned int* g,\n"
+    "                             long unsigned int* f)\n"
+    "{\n" + regcode + "}\n";
+  fout << code;
+
+  if ( DEBUG < 0 ) cout << GREEN << code << DEFAULT_COLOR;
+
+  cout << endl
+       << "compiling TNM buffers:"
        << endl << endl;
+  if ( ! gInterpreter->Declare(code.c_str()) )
+    // Have a tantrum!
+    throw edm::Exception(edm::errors::Configuration,
+			 "cfg error: " + BOLDRED +
+			 "unable to compile code in jit_code.cc"
+			 + DEFAULT_COLOR);
+  cout << "done compiling TNM buffers" << endl;
+
+  vector<long unsigned int> baddr(blockName_.size()+1, 0);
+  vector<long unsigned int> vaddr(nvar+1, 0);
+  gaddr.push_back(0);
+  gfunc.push_back(0);
+  sprintf(record, 
+	  "tnm_register((long unsigned int*)0x%lx,"
+	  " (long unsigned int*)0x%lx,"
+	  " (long unsigned int*)0x%lx,"
+	  " (long unsigned int*)0x%lx);",
+	  (long unsigned int)&baddr[0],
+	  (long unsigned int)&vaddr[0],
+	  (long unsigned int)&gaddr[0],
+	  (long unsigned int)&gfunc[0]);
+  gROOT->ProcessLine(record);
+
+  for(size_t k=0; k < gkey.size(); k++)
+    tnm_register_getter(gkey[k], gclass[k], gaddr[k], gfunc[k]);
+
+  // wire buffers, variables and getters together
+  nvar = 0;
+  for(int ii=0; ii < (int)blockName_.size(); ii++)
+    {
+      buffers.push_back((BufferThing*)baddr[ii]);
+      buffermap[prefix_[ii]] = buffers.back();
+      BufferThing* pbuffer = buffers.back();
+      bool fuse = fuseGetters_ || cut_[ii] != "" || derived_[ii];
+      for(size_t jj=0; jj < variables_[ii].size(); jj++)
+	{
+	  VariableThing* pvar = (VariableThing*)vaddr[nvar];
+	  nvar++;
+	  pvar->bits    = variables_[ii][jj].bits;
+	  pvar->packed  = variables_[ii][jj].packed;
+	  pvar->flatten = flattenNested_;
+	  pbuffer->add(pvar);
+	  variablemap[variables_[ii][jj].branchname] = pvar;
+	  if ( ! fuse && ! lazyJit_ && ! simpletype_[ii] )
+	    {
+	      int k = vgetter[ii][jj];
+	      pvar->bind(gclass[k], gaddr[k], gfunc[k]);
+	    }
+	}
+      if ( fuse && bgetter[ii] > -1 )
+	{
+	  int k = bgetter[ii];
+	  pbuffer->bind(gclass[k], gaddr[k], gfunc[k]);
+	}
+
+      // Now initialize buffer
+      pbuffer->useNative(getterMode_ == "native");
+      pbuffer->useArrays(arrayLayout_);
+      pbuffer->select(cut_[ii]);
+      pbuffer->init(this, label_[ii]);
+      if ( lazyJit_ ) pbuffer->defer(fuse);
+    }
 }
 
 
@@ -903,11 +2366,25 @@ void
 TheNtupleMaker::analyze(const edm::Event& iEvent, 
                         const edm::EventSetup& iSetup)
 {
+  // Skip events not selected by the optional pre-sampling
+  if ( skipEvent(iEvent) ) return;
+
   // Cache current event and event setup
   CurrentEvent::instance().set(iEvent, iSetup);
 
-  // Call methods for each buffer
-  for(size_t i=0; i < buffers.size(); i++) buffers[i]->get(iEvent);
+  // Prescales change only at lumi section boundaries
+  if ( prescaleProvider_ && 
+       ( prescaleRun_  != iEvent.id().run() ||
+	 prescaleLumi_ != iEvent.luminosityBlock() ) )
+    refreshPrescales(iEvent, iSetup);
+
+  // Call methods for each buffer, concurrently if requested. If there is
+  // an event filter, the buffers it needs are called first and the others
+  // only if the event passes. The tree is filled only after all buffers 
+  // are done.
+  getBuffers(filterBuffers_, iEvent);
+  bool keep = filter_ == 0 || passFilter();
+  if ( keep ) getBuffers(otherBuffers_, iEvent);
 
   //inputCount_++;
   count_++;
@@ -917,10 +2394,17 @@ TheNtupleMaker::analyze(const edm::Event& iEvent,
   // Apply optional cuts
 
   //if ( ! selectEvent(iEvent) ) return;
+  if ( ! keep ) return;
+  keptCount_++;
 
   // Fill output ntuple
 
+  fillwatch_.Start(false);
   tree->Fill();
+  fillwatch_.Stop();
+
+  if ( autoTuneEvents_ > 0 && tree->GetEntries() == autoTuneEvents_ ) 
+    tuneBaskets();
 }
 
 bool
@@ -1130,44 +2614,56 @@ TheNtupleMaker::beginRun(const edm::Run& run,
                 << std::endl;
 	    }          
 
-          // Update trigger names file
-
           triggerNames_ = HLTconfig_.triggerNames();
 
-          unsigned int startrun = run.run();
-          unsigned int endrun   = run.run();
-          set<string> nameset;
+          // Identify the menu by a hash of its name and trigger names
+          if ( HLTchanged || menuHash_ == "" )
+            {
+              menuTable_ = HLTconfig_.tableName();
+              string menu = menuTable_;
+              for(unsigned int i=0; i < triggerNames_.size(); i++)
+                menu += "\n" + triggerNames_[i];
+              menuHash_ = tnm_hash(menu);
+            }
 
-	  ifstream fin("triggerNames.txt");
-	  if ( fin.good() )
+          // Add a new menu to the catalogue and to the trigger names
+          // file, and extend the range of runs of a known menu
+          std::map<std::string, MenuRecord>::iterator 
+            menu = menus_.find(menuHash_);
+          if ( menu == menus_.end() )
+            {
+              MenuRecord record;
+              record.hash     = menuHash_;
+              record.table    = menuTable_;
+              record.names    = triggerNames_;
+              record.firstRun = run.run();
+              record.lastRun  = run.run();
+              menus_[menuHash_] = record;
+              updateTriggerNamesFile(record);
+            }
+          else
+            {
+              menu->second.firstRun = std::min(menu->second.firstRun,
+                                               run.run());
+              menu->second.lastRun  = std::max(menu->second.lastRun,
+                                               run.run());
+            }
+
+          // Resolve triggers stored as bits (the matches are cached)
+          if ( triggerBuffer_ ) indexTriggers();
+
+          // Resolve triggers whose prescales are cached
+          if ( prescaleProvider_ )
 	    {
-	      int n;
-	      string line;
-	      try
-		{
-		  fin >> line >> line >> startrun; // get start run
-		  fin >> line >> line >> n;
-		  fin >> line >> line >> n;
-		}
-	      catch (...)
-		{}
-	      
-	      while ( fin >> line ) nameset.insert(line);
-	      fin.close();
+	      bool changed = true;
+	      prescaleProvider_->init(run, eventsetup, 
+				      triggerResults_.process(), changed);
+	      std::vector<unsigned int> index = 
+		matchTriggers(prescalePatterns_);
+	      prescaleNames_.clear();
+	      for(size_t k=0; k < index.size(); k++) 
+		prescaleNames_.push_back(triggerNames_[index[k]]);
 	    }
-
-          // Write out updated trigger names
-          ofstream fout("triggerNames.txt");
-          fout << "FIRST RUN:     " << startrun << endl;
-          fout << "LAST  RUN:     " << endrun   << endl;
-          for(unsigned int  i=0; i < triggerNames_.size(); i++)
-            nameset.insert(triggerNames_[i]);
-          fout << "TRIGGER COUNT: " << nameset.size()   << endl;
-
-          for(set<string>::iterator it=nameset.begin();
-              it != nameset.end(); it++)
-            fout << "\t" << *it << std::endl;
-          fout.close();
         }
       else
         {
@@ -1194,6 +2690,20 @@ TheNtupleMaker::beginRun(const edm::Run& run,
         << std::endl;
     }
 
+  // Write the names of the triggers stored as bits for this run
+  if ( triggerBuffer_ )
+    {
+      if ( ! HLTconfigured )
+	{
+	  triggerNames_.clear();
+	  menuHash_ = "";
+	  indexTriggers();
+	}
+      triggerRun_ = run.run();
+      ttree_->Fill();
+      indexFilterTriggers();
+    }
+
   // Update HLT config pointer
 
   if ( HLTconfigured ) 
@@ -1206,6 +2716,9 @@ TheNtupleMaker::beginRun(const edm::Run& run,
       << "END Run: " << run.run() << endl;
 }
 
+void 
+TheNtupleMaker::endRun(const edm::Run&, const edm::EventSetup&) {}
+
 void 
 TheNtupleMaker::createBranchnames(std::string blockName,    
 				  std::string prefix,
@@ -1305,10 +2818,33 @@ TheNtupleMaker::createBranchnames(std::string blockName,
       if ( maxcount > 1 ) 
 	dressed_rtype = string("vector<") + rtype + string(">");
 
+      // array layout: the counter is listed before the first array and 
+      // the array is listed as <type>[<counter>]
+      string vbranchname = branchname;
+      if ( arrayLayout_ && maxcount > 1 && 
+	   tnm_leaf_type(rtype) != "" && ! var[i].packed )
+	{
+	  string counter = tnm_counter_branchname(branchname);
+	  if ( branchcount.find(counter) == branchcount.end() )
+	    {
+	      branchcount[counter] = 1;
+	      vout << "int/" << counter << "/" << blockName << "/1" 
+		   << std::endl;
+	    }
+	  dressed_rtype = rtype + "[" + counter + "]";
+	  vbranchname   = tnm_array_branchname(branchname);
+	}
+
+      // nested layout: a flat vector plus a vector of offsets
+      bool flattened = flattenNested_ && maxcount > 1 && 
+	(rtype.substr(0, 7) == "vector<" || 
+	 rtype.substr(0, 12) == "std::vector<");
+      if ( flattened ) dressed_rtype = rtype;
+
       if ( varname == "" )
 	{
 	  vout << dressed_rtype << "/" 
-	       << branchname << "/"
+	       << vbranchname << "/"
 	       << blockName  << "/"
 	       << maxcount 
 	       << std::endl;
@@ -1316,11 +2852,17 @@ TheNtupleMaker::createBranchnames(std::string blockName,
       else
 	{
 	  vout << dressed_rtype << "/" 
-	       << branchname  << "/"
+	       << vbranchname << "/"
 	       << blockName + "_" + varname << "/"
 	       << maxcount 
 	       << std::endl;
 	}
+      if ( flattened )
+	vout << "vector<int>/" 
+	     << branchname << "_offsets/"
+	     << blockName  << "/"
+	     << maxcount + 1
+	     << std::endl;
       
       // Note: nvar <= i
       var[nvar].branchname   = branchname;
@@ -1363,11 +2905,74 @@ TheNtupleMaker::endJob()
 	   << endl << endl;
     }
 
+  // Time during which the event loop was blocked filling the tree
+  long nfilled = (long)tree->GetEntries();
+  if ( nfilled > 0 )
+    {
+      sprintf(cmd, "%8.3f", 1000 * fillwatch_.RealTime() / nfilled);
+      cout << BOLDYELLOW
+	   << "fill time/event: " << cmd << " ms" << DEFAULT_COLOR
+	   << endl << endl;
+    }
+
+  // Summarize pre-sampling
+  if ( seenCount_ > count_ )
+    cout << BOLDYELLOW
+	 << "events sampled: " << count_ << " of " << seenCount_
+	 << DEFAULT_COLOR << endl << endl;
+
+  // Summarize event filter
+  if ( filter_ )
+    cout << BOLDYELLOW
+	 << "events kept by eventFilter: " << keptCount_ << " of " << count_
+	 << DEFAULT_COLOR << endl << endl;
+
+  // Summarize missing products
+  std::ostringstream os;
+  int nmissing = 0;
+  for(size_t i=0; i < buffers.size(); i++)
+    {
+      long count = buffers[i]->missingCount();
+      if ( count == 0 ) continue;
+      nmissing++;
+      sprintf(cmd, "%10ld", count);
+      os << cmd << "\t" << buffers[i]->productName() << endl;
+    }
+  if ( nmissing > 0 )
+    edm::LogWarning("getByTokenFailure")
+      << RED << "number of events in which products were missing:" << endl
+      << os.str()
+      << DEFAULT_COLOR
+      << endl;
+
+  // Write the catalogue of HLT menus, now that their run ranges are known
+  for(std::map<std::string, MenuRecord>::iterator 
+	it=menus_.begin(); it != menus_.end(); it++)
+    {
+      menuRecord_ = it->second;
+      mtree_->Fill();
+    }
+
   //if ( macroEnabled_ ) gROOT->ProcessLine("obj.endJob();");
 
   //output.close();
 }
 
+// ------------ method called when a new input file is opened  ------------
+void
+TheNtupleMaker::respondToOpenInputFile(const edm::FileBlock&)
+{
+  // Restart count of events per file (see firstEventsPerFile)
+  fileEventCount_ = 0;
+
+  // Forget which products were missing from the previous file
+  for(size_t i=0; i < buffers.size(); i++)
+    buffers[i]->openFile(skipMissingProducts_);
+}
+
+void
+TheNtupleMaker::respondToCloseInputFile(const edm::FileBlock&) {}
+
 TTree* TheNtupleMaker::getTree() { return tree; }
 
 //define this as a plug-in
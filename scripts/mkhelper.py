@@ -279,7 +279,10 @@ using namespace std;
 //
 //}
 
-// -- Called once per object
+// -- Called once per object. If called through analyzeObjectOnce(), it is
+// -- called once per object per event however many access methods are
+// -- used. Cache results for the access methods with setResult(name, value)
+// -- and read them with result(name).
 //void %(name)s::analyzeObject()
 //{
 //
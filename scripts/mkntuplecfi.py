@@ -53,8 +53,10 @@ PLUGINSDIR= "%s/plugins" % PKGDIR
 def usage():
 	sys.exit("""
 Usage:
-      mkntuplecfi.py [root-file-dir]
+      mkntuplecfi.py [--compact] [root-file-dir]
    
+      --compact         annotate methods so that doubles are stored as
+                        floats and bools are packed into a flags branch
       root-file-dir     directory containing root files. If omitted,
 		                  the default is the current directory
 		""")
@@ -62,6 +64,9 @@ Usage:
 ARGV = sys.argv[1:]
 if len(ARGV) > 0 and ARGV[0] == "?": usage()
 
+COMPACT = "--compact" in ARGV
+if COMPACT: ARGV.remove("--compact")
+
 # Make sure CMSSW is set up
 if "CMSSW_BASE" not in os.environ:
 	sys.exit("\t*** please set up CMSSW first\n")
@@ -1287,8 +1292,14 @@ class Gui:
 
 			# create a blockName from cname
                         if simpleType:
-                                t = vectorValue.findall(cname)
-                                if len(t) > 0: cname = t[0]
+                                # a vector<vector<simple> > is read as
+                                # vector<simple> with maxcount > 1
+                                vv = isSimpleVectorVectorType.findall(cname)
+                                t  = vectorValue.findall(cname)
+                                if len(vv) > 0:
+                                        cname = "vector<%s>" % vv[0]
+                                elif len(t) > 0:
+                                        cname = t[0]
                                 blockName = labels[0]
                                 blockName = blockName.capitalize()
                                 # strip away possible vector decoration
@@ -1417,7 +1428,8 @@ class Gui:
                                 delim = tab2
                                 for index, method in enumerate(methods):
                                         self.statusBar.SetText(method, 1)
-                                        record = "%s'%s'" % (delim, method)
+                                        record = "%s'%s'" % \
+                                                 (delim, compactMethod(method))
                                         delim  = ",\n%s"  % tab2
                                         out.write(record)
                         out.write('\n%s)' % tab1)
@@ -1449,6 +1461,17 @@ class Gui:
 		ROOT.gApplication.Run()
 
 #------------------------------------------------------------------------------
+# Add storage annotation to a method (see TheNtupleMaker constructor)
+def compactMethod(method):
+	if not COMPACT: return method
+	t = method.split()
+	if len(t) < 2: return method
+	if t[0] == "double":
+		return "%s as float" % method
+	elif t[0] == "bool":
+		return "%s as bit" % method
+	return method
+#------------------------------------------------------------------------------
 #---- Main program ------------------------------------------------------------
 #------------------------------------------------------------------------------
 def main():
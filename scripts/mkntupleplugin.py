@@ -0,0 +1,715 @@
+#!/usr/bin/env python
+#------------------------------------------------------------------------------
+# File:        mkntupleplugin.py
+# Description: Ahead-of-time compiler for TheNtupleMaker. Read the buffers
+#              of an ntuple_cfi.py file, using the same grammar as the
+#              TheNtupleMaker constructor, and write a static (no JIT)
+#              EDM analyzer plugin, plus its BuildFile.xml, that creates
+#              the same ntuple.
+# Created:     18-Oct-2026
+#------------------------------------------------------------------------------
+import os, sys, re
+from time import ctime
+#------------------------------------------------------------------------------
+def usage():
+        sys.exit('''
+Usage:
+      mkntupleplugin.py [cfi-file] [plugin-name] [package]
+
+      cfi-file          configuration fragment containing the
+                        TheNtupleMaker module (default: python/ntuple_cfi.py)
+      plugin-name       name of analyzer plugin (default: TheNtupleMakerAOT)
+      package           package <Pkg>/<Sub> in whose plugins directory,
+                        $CMSSW_BASE/src/<Pkg>/<Sub>/plugins, the plugin and
+                        its BuildFile.xml are written
+                        (default: TNM/<plugin-name>)
+
+      then build the plugin with
+        cd $CMSSW_BASE/src/<Pkg>/<Sub>
+        scram b
+      and, in the cfg file, replace "TheNtupleMaker" by the plugin name.
+''')
+
+ARGV = sys.argv[1:]
+if len(ARGV) > 0 and ARGV[0] in ["?", "-h", "--help"]: usage()
+
+CFI_FILE = "python/ntuple_cfi.py"
+NAME     = "TheNtupleMakerAOT"
+if len(ARGV) > 0: CFI_FILE = ARGV[0]
+if len(ARGV) > 1: NAME     = ARGV[1]
+PACKAGE  = "TNM/%s" % NAME
+if len(ARGV) > 2: PACKAGE  = ARGV[2].strip('/')
+if len(PACKAGE.split('/')) != 2:
+        sys.exit("\t*** package must be of the form <Pkg>/<Sub>\n")
+
+# Make sure CMSSW is set up
+if "CMSSW_BASE" not in os.environ:
+        sys.exit("\t*** please set up CMSSW first\n")
+
+# scram builds EDM plugins only from the plugins directory of a package
+PKGDIR   = "%s/src/%s" % (os.environ["CMSSW_BASE"], PACKAGE)
+OUTDIR   = "%s/plugins" % PKGDIR
+#------------------------------------------------------------------------------
+# Regular expressions used by the TheNtupleMaker constructor
+#------------------------------------------------------------------------------
+getmethod    = re.compile(r'[a-zA-Z][^ ]*[(].*[)][^ ]*|[a-zA-Z][a-zA-Z0-9]*$')
+getparam     = re.compile(r'^ *param +')
+getexpr      = re.compile(r'^ *expr +(.+?) +([a-zA-Z_][a-zA-Z0-9_]*) *= *(.+)$')
+getvarprefix = re.compile(r'(?<=/)[a-zA-Z0-9]+')
+getlabel     = re.compile(r'[a-zA-Z0-9]+(?=/)')
+getrange     = re.compile(r'[0-9]+[.][.]+[0-9]+')
+getstrarg    = re.compile(r'(?<=[(]").+(?="[)])')
+getnspace    = re.compile(r'^(edm|reco|pat|l1extra|trigger)')
+getstorage   = re.compile(r'[ ]+as[ ]+([a-zA-Z0-9_:]+)[ ]*$')
+getsimpletype= re.compile(r'^(float|double|int|long|unsigned'\
+                          '|size_t|short|bool|char|string|std::string)')
+getnestedtype= re.compile(r'^(std::)?vector<[ ]*((unsigned )?'\
+                          '(float|double|int|long|size_t|short'\
+                          '|bool|char))[ ]*>$')
+
+# Regular expressions used by TheNtupleMaker::createBranchnames
+stripme      = re.compile(r'-[>]|[.]|"|[(]|[)]| |,|[<]|[>]')
+strip3_      = re.compile(r'___')
+strip2_      = re.compile(r'__')
+strip2_atend = re.compile(r'_$')
+#------------------------------------------------------------------------------
+def fatal(message):
+        sys.exit("** error ** %s" % message)
+
+def bisplit(s, delim):
+        i = s.find(delim)
+        if i > 0:
+                return (s[:i], s[i+len(delim):])
+        return (s, "")
+
+# math functions that may be called in a cut or a derived expression
+MATHFUNCS = ['abs', 'fabs', 'sqrt', 'pow', 'exp', 'log', 'log10',
+             'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2',
+             'sinh', 'cosh', 'tanh', 'hypot', 'min', 'max',
+             'floor', 'ceil', 'round']
+getcallname  = re.compile(r'"[^"]*"|[0-9][a-zA-Z0-9.]*|[a-zA-Z_][a-zA-Z0-9_]*')
+
+def cutExpression(cut, values={}):
+        # prefix every unqualified call in cut, other than to a math
+        # function, with "x." and replace every name in values, that is 
+        # not a call, by its value (see tnm_cut_expression and
+        # tnm_derived_expression)
+        expr = ''
+        last = 0
+        for m in getcallname.finditer(cut):
+                name  = m.group(0)
+                start = m.start()
+                expr += cut[last:start]
+                last  = m.end()
+                if not (name[0].isalpha() or name[0] == '_'):
+                        expr += name
+                        continue
+                qualified = cut[:start].endswith('.') or \
+                            cut[:start].endswith('->') or \
+                            cut[:start].endswith('::')
+                call = cut[last:].lstrip(' ').startswith('(')
+                scope = cut[last:].lstrip(' ').startswith('::')
+                if not (call or qualified or scope) and name in values:
+                        expr += values[name]
+                        continue
+                if call and not qualified:
+                        if name in MATHFUNCS:
+                                expr += 'std::'
+                        else:
+                                expr += 'x.'
+                expr += name
+        expr += cut[last:]
+        return expr
+
+def isSimpleType(name):
+        return getsimpletype.search(name.lower()) != None
+
+def decodeStorage(storage, variable):
+        # return (rtype, mantissa bits, packed) for a storage annotation
+        # of variable, e.g., "Jet: double pt() as float:12"
+        if storage in ["uchar", "ushort", "uint"]:
+                return ("unsigned " + {'uchar': 'char',
+                                       'ushort': 'short',
+                                       'uint': 'int'}[storage], 0, False)
+        if storage in ["float16", "Float16_t"]:
+                return ("float", 10, False)
+        if storage == "bit":
+                return ("bool", 0, True)
+        if storage[:6] == "float:":
+                bits = int(storage[6:])
+                if bits < 1 or bits > 22:
+                        fatal('mantissa bits must be 1 to 22, not %d, '\
+                              'in "as %s" of %s' % (bits, storage, variable))
+                return ("float", bits, False)
+        if storage in ["float", "double", "char", "short",
+                       "int", "long", "bool"]:
+                return (storage, 0, False)
+        fatal('unknown storage type in "as %s" of %s' % \
+              (storage, variable))
+#------------------------------------------------------------------------------
+# Load the TheNtupleMaker module from the cfi file
+#------------------------------------------------------------------------------
+def loadModule(filename):
+        if not os.path.exists(filename):
+                fatal("file %s not found" % filename)
+        import FWCore.ParameterSet.Config as cms
+        names = {}
+        exec(open(filename).read(), names)
+        for key, obj in names.items():
+                if not isinstance(obj, cms.EDAnalyzer): continue
+                if obj.type_() == "TheNtupleMaker": return obj
+        fatal("no TheNtupleMaker module found in %s" % filename)
+#------------------------------------------------------------------------------
+# Decode buffers (blocks) exactly as the TheNtupleMaker constructor does
+#------------------------------------------------------------------------------
+def decodeBuffers(tnm):
+        includeLabel = True
+        if hasattr(tnm, "includeLabel"):
+                includeLabel = tnm.includeLabel.value()
+
+        blocks = []
+        for blockName in tnm.buffers.value():
+                records = getattr(tnm, blockName).value()
+                record  = records[0]
+                field   = record.split()
+
+                className  = field[0]
+                bufferName = className.replace("::", "")
+                simpletype = isSimpleType(bufferName)
+
+                # a vector of a simple type is also a simple type. if
+                # maxcount > 1, the product is a vector<vector<T> >
+                t = getnestedtype.search(className)
+                nestedtype = t != None
+                if nestedtype:
+                        className  = "std::vector<%s>" % t.group(2)
+                        simpletype = True
+
+                # backwards compatibility with ROOT 5 version of TNM
+                if className == bufferName and not simpletype:
+                        t = getnspace.findall(bufferName)
+                        if len(t) > 0:
+                                className = bufferName.replace(t[0],
+                                                               t[0] + "::")
+                prefix = ""
+                if not simpletype: prefix = bufferName
+                varprefix = ""
+                label = ""
+                maxcount = 1
+
+                if bufferName[:8] != "edmEvent" and len(field) < 3:
+                        fatal("you need at least 3 fields in first line "
+                              "of buffer %s" % blockName)
+
+                if len(field) > 1: label = field[1]
+                t = getvarprefix.findall(record)
+                if len(t) > 0:
+                        varprefix = t[0].strip()
+                        t = getlabel.findall(record)
+                        if len(t) == 0:
+                                fatal("check getByToken, expected "
+                                      "<label>[/<prefix>] in %s" % record)
+                        label = t[0]
+
+                if len(field) > 2: maxcount = int(field[2])
+
+                if len(field) > 3:
+                        prefix = field[3]
+                elif prefix == "":
+                        prefix = label.replace("::", "_")
+                elif includeLabel and label != "":
+                        prefix += "_" + label.replace("::", "_")
+                if varprefix != "": prefix += "_" + varprefix
+
+                var = []
+                parameters = {}
+                if nestedtype:
+                        var.append((className, "", "", 0, False))
+                elif simpletype:
+                        var.append((bufferName, "", "", 0, False))
+                else:
+                        for record in records[1:]:
+                                if getparam.search(record) != None:
+                                        param = getparam.sub("", record)
+                                        key, value = bisplit(param, "=")
+                                        parameters[key.strip()]=value.strip()
+                                        continue
+
+                                # derived variable: its method is the
+                                # expression prefixed by "="
+                                t = getexpr.search(record)
+                                if t != None:
+                                        var.append((t.group(1).strip(),
+                                                    "=" + t.group(3).strip(),
+                                                    t.group(2), 0, False))
+                                        continue
+
+                                # check for a storage annotation
+                                rstorage, bits, packed = ("", 0, False)
+                                t = getstorage.search(record)
+                                if t != None:
+                                        rstorage, bits, packed = \
+                                                  decodeStorage(t.group(1),
+                                                                "%s: %s" % \
+                                                                (blockName,
+                                                                 record))
+                                        record = record[:t.start()]
+
+                                t = getmethod.findall(record)
+                                if len(t) == 0:
+                                        fatal("I can't get method name "
+                                              "from\n%s" % record)
+                                method  = t[0].strip()
+                                varname = method
+                                t = getstrarg.findall(method)
+                                if len(t) > 0:
+                                        varname = t[0]
+                                        if method[:8] == "prescale":
+                                                varname = "prescale"+varname
+
+                                left, right = bisplit(record, method)
+                                rtype = left.strip()
+                                if rstorage != "": rtype = rstorage
+                                right = right.strip()
+                                if right != "": varname = right
+
+                                t = getrange.findall(method)
+                                if len(t) == 0:
+                                        var.append((rtype, method, varname,
+                                                    bits, packed))
+                                        continue
+                                rng = t[0]
+                                start, end = [int(x) for x in
+                                              rng.replace(".", " ").split()]
+                                vname = varname.replace(rng, "")
+                                for ind in range(start, end+1):
+                                        var.append((rtype,
+                                                    method.replace(rng,
+                                                                   str(ind)),
+                                                    vname + str(ind),
+                                                    bits, packed))
+
+                blocks.append({'blockName':  blockName,
+                               'className':  className,
+                               'simpletype': simpletype,
+                               'label':      label,
+                               'maxcount':   maxcount,
+                               'prefix':     prefix,
+                               'parameters': parameters,
+                               'var':        var})
+        return blocks
+#------------------------------------------------------------------------------
+# Create branch names exactly as TheNtupleMaker::createBranchnames does
+#------------------------------------------------------------------------------
+def createBranchnames(blocks):
+        branchcount = {}
+        for block in blocks:
+                prefix = block['prefix']
+                names  = []
+                for rtype, method, varname, bits, packed in block['var']:
+                        varname = stripme.sub("_", varname)
+                        varname = strip3_.sub("_", varname)
+                        varname = strip2_.sub("_", varname)
+                        varname = strip2_atend.sub("", varname)
+
+                        branchname = prefix
+                        if varname != "": branchname += "." + varname
+
+                        if branchname not in branchcount:
+                                branchcount[branchname] = 1
+                        else:
+                                nn = branchcount[branchname]
+                                branchcount[branchname] = nn + 1
+                                branchname = "%s%d_.%s" % (prefix, nn,
+                                                           varname)
+                        names.append(branchname)
+                block['branchnames'] = names
+#------------------------------------------------------------------------------
+# Find the header that declares each class
+#------------------------------------------------------------------------------
+def findHeaders(blocks):
+        import ROOT
+        import PhysicsTools.TheNtupleMaker.AutoLoader
+        headers  = []
+        packages = []
+        for block in blocks:
+                cname = block['className']
+                if block['simpletype']: continue
+                c = ROOT.TClass.GetClass(cname)
+                if not c:
+                        fatal("unable to get class %s" % cname)
+                header = c.GetDeclFileName()
+                if header == None or header == "":
+                        fatal("unable to get header of class %s" % cname)
+                if header not in headers: headers.append(header)
+                package = "/".join(header.split("/")[:2])
+                if package not in packages: packages.append(package)
+        return (headers, packages)
+#------------------------------------------------------------------------------
+# Write code
+#------------------------------------------------------------------------------
+def objectType(block):
+        if block['maxcount'] > 1:
+                return "std::vector<%s>" % block['className']
+        return block['className']
+
+def flagType(block):
+        # smallest type that holds the flags (as bit) of a block, as in
+        # Buffer::init
+        nflags = len([v for v in block['var'] if v[4]])
+        if nflags <= 8:  return "UChar_t"
+        if nflags <= 16: return "UShort_t"
+        if nflags <= 32: return "UInt_t"
+        return "ULong64_t"
+
+def flagBranch(block):
+        # name of branch into which the flags (as bit) of a block are packed
+        for jj, v in enumerate(block['var']):
+                if v[4]:
+                        return block['branchnames'][jj].split(".")[0] + \
+                               ".flags"
+        return ""
+
+def flagTable(blocks):
+        table = ""
+        for block in blocks:
+                bit = 0
+                for jj, v in enumerate(block['var']):
+                        if not v[4]: continue
+                        if bit == 64:
+                                fatal("more than 64 flags (as bit) in %s" % \
+                                      block['blockName'])
+                        table += "%s %d %s\n" % (flagBranch(block), bit,
+                                                 block['branchnames'][jj])
+                        bit += 1
+        return table
+
+def writeCode(blocks, headers):
+        tab = "  "
+        names = {'name': NAME,
+                 'time': ctime(),
+                 'cfi':  CFI_FILE,
+                 'nblocks': len(blocks)}
+        code = []
+        code.append('''// ----------------------------------------------------------------------------
+// File:    %(name)s.cc
+// Created: %(time)s by mkntupleplugin.py
+//          from %(cfi)s
+//
+// A static version of TheNtupleMaker: every getter is compiled ahead of
+// time, so the job starts at once and the compiler can inline the calls.
+// The branch names are identical to those created by TheNtupleMaker.
+// ----------------------------------------------------------------------------
+#include <algorithm>
+#include <cmath>
+#include <vector>
+#include <string>
+#include <iostream>
+
+#include "FWCore/Framework/interface/one/EDAnalyzer.h"
+#include "FWCore/Framework/interface/Event.h"
+#include "FWCore/Framework/interface/Frameworkfwd.h"
+#include "FWCore/Framework/interface/FileBlock.h"
+#include "FWCore/Framework/interface/MakerMacros.h"
+#include "FWCore/ParameterSet/interface/ParameterSet.h"
+#include "FWCore/MessageLogger/interface/MessageLogger.h"
+#include "FWCore/ServiceRegistry/interface/Service.h"
+#include "CommonTools/UtilAlgos/interface/TFileService.h"
+#include "DataFormats/Common/interface/Handle.h"
+#include "PhysicsTools/TheNtupleMaker/interface/tnmutil.h"
+#include "PhysicsTools/TheNtupleMaker/interface/kit.h"
+#include "TTree.h"
+''' % names)
+        for header in headers:
+                code.append('#include "%s"\n' % header)
+
+        # class declaration
+        code.append('''// ----------------------------------------------------------------------------
+class %(name)s :
+  public edm::one::EDAnalyzer<edm::one::SharedResources,
+                              edm::WatchInputFiles>
+{
+public:
+  explicit %(name)s(const edm::ParameterSet&);
+  ~%(name)s() {}
+  void analyze(const edm::Event&, const edm::EventSetup&) override;
+  void respondToOpenInputFile(const edm::FileBlock&) override;
+  void respondToCloseInputFile(const edm::FileBlock&) override {}
+
+private:
+  TTree* tree;
+  // products already reported missing in the current file
+  std::vector<bool> missing;
+''' % names)
+        for ii, block in enumerate(blocks):
+                code.append('\n%s// BLOCK( %s )\n' % (tab, block['blockName']))
+                code.append('%sedm::EDGetTokenT<%s > token%d;\n' % \
+                            (tab, objectType(block), ii))
+                for jj, (rtype, method, varname, bits, packed) in \
+                            enumerate(block['var']):
+                        if packed: continue
+                        if block['maxcount'] > 1:
+                                code.append('%sstd::vector<%s> b%d_%d;\n' % \
+                                            (tab, rtype, ii, jj))
+                        else:
+                                code.append('%s%s b%d_%d;\n' % \
+                                            (tab, rtype, ii, jj))
+                if flagBranch(block) != "":
+                        if block['maxcount'] > 1:
+                                code.append('%sstd::vector<%s> '\
+                                            'b%d_flags;\n' % \
+                                            (tab, flagType(block), ii))
+                        else:
+                                code.append('%s%s b%d_flags;\n' % \
+                                            (tab, flagType(block), ii))
+        code.append('};\n\n')
+
+        # constructor
+        code.append('''%(name)s::%(name)s(const edm::ParameterSet& iConfig)
+{
+  usesResource("TFileService");
+  edm::Service<TFileService> fs;
+  tree = fs->make<TTree>("Events", "created by %(name)s (mkntupleplugin.py)");
+  missing.assign(%(nblocks)d, false);
+''' % names)
+        for ii, block in enumerate(blocks):
+                label = block['label']
+                i = label.find("_")
+                if i > 0:
+                        label1, label2 = label[:i], label[i+1:]
+                else:
+                        label1, label2 = label, ""
+                code.append('\n%s// BLOCK( %s )\n' % (tab, block['blockName']))
+                code.append('%stoken%d = consumes<%s >'\
+                            '(edm::InputTag("%s", "%s"));\n' % \
+                            (tab, ii, objectType(block), label1, label2))
+                for jj, branchname in enumerate(block['branchnames']):
+                        if block['var'][jj][4]: continue
+                        if block['maxcount'] > 1:
+                                code.append('%sb%d_%d.reserve(%d);\n' % \
+                                            (tab, ii, jj, block['maxcount']))
+                        code.append('%stree->Branch("%s", &b%d_%d);\n' % \
+                                    (tab, branchname, ii, jj))
+                if flagBranch(block) != "":
+                        code.append('%stree->Branch("%s", &b%d_flags);\n' % \
+                                    (tab, flagBranch(block), ii))
+
+        # decoding table of packed flags
+        table = flagTable(blocks)
+        if table != "":
+                code.append('''
+  // decoding table of packed flags: <flags branch> <bit> <flag>
+  static std::string flags("%s");
+  TTree* ptree = fs->make<TTree>("Provenance", "created by %s");
+  ptree->Branch("flags", (void*)(flags.c_str()), "flags/C");
+  ptree->Fill();
+''' % (table.replace("\n", "\\n"), NAME))
+        code.append('}\n\n')
+
+        # analyze
+        code.append('''void
+%(name)s::analyze(const edm::Event& event, const edm::EventSetup&)
+{
+''' % names)
+        for ii, block in enumerate(blocks):
+                simpletype = block['simpletype']
+                vectortype = block['maxcount'] > 1
+                code.append('%s// BLOCK( %s )\n' % (tab, block['blockName']))
+                code.append('%s{\n' % tab)
+                t2 = tab*2
+                hasflags   = flagBranch(block) != ""
+                if vectortype:
+                        for jj in range(len(block['var'])):
+                                if block['var'][jj][4]: continue
+                                code.append('%sb%d_%d.clear();\n' % \
+                                            (t2, ii, jj))
+                        if hasflags:
+                                code.append('%sb%d_flags.clear();\n' % \
+                                            (t2, ii))
+                else:
+                        # reset singletons so that a missing product does
+                        # not repeat the values of the previous event (see
+                        # Buffer::fetch)
+                        for jj in range(len(block['var'])):
+                                if block['var'][jj][4]: continue
+                                code.append('%sb%d_%d = decltype(b%d_%d)();\n'\
+                                            % (t2, ii, jj, ii, jj))
+                        if hasflags:
+                                code.append('%sb%d_flags = 0;\n' % (t2, ii))
+                code.append('%sedm::Handle<%s > h;\n' % \
+                            (t2, objectType(block)))
+                code.append('%sevent.getByToken(token%d, h);\n' % (t2, ii))
+                code.append('%sif ( h.isValid() )\n%s  {\n' % (t2, t2))
+                t4 = tab*4
+                cut = ''
+                if vectortype and 'cut' in block['parameters']:
+                        cut = block['parameters']['cut']
+                if cut != '':
+                        # store only objects that pass the cut
+                        code.append('%ssize_t n = 0;\n' % t4)
+                        code.append('%sfor(size_t c=0; c < h->size() && '\
+                                    'n < (size_t)%d; c++)\n' % \
+                                    (t4, block['maxcount']))
+                        code.append('%s  {\n' % t4)
+                        t4 = tab*6
+                        code.append('%sconst %s& x = (*h)[c];\n' % \
+                                    (t4, block['className']))
+                        code.append('%sbool selected = false;\n' % t4)
+                        code.append('%stry\n' % t4)
+                        code.append('%s  {\n' % t4)
+                        code.append('%s    selected = %s;\n' % \
+                                    (t4, cutExpression(cut)))
+                        code.append('%s  }\n' % t4)
+                        code.append('%scatch (...)\n' % t4)
+                        code.append('%s  {\n' % t4)
+                        code.append('%s    edm::LogWarning("FAILEDCALL")\n'%t4)
+                        code.append('%s      << "%s cut" << std::endl;\n' % \
+                                    (t4, block['blockName']))
+                        code.append('%s  }\n' % t4)
+                        code.append('%sif ( ! selected ) continue;\n' % t4)
+                        code.append('%sn++;\n' % t4)
+                elif vectortype:
+                        code.append('%ssize_t n = std::min(h->size(), '\
+                                    '(size_t)%d);\n' % \
+                                    (t4, block['maxcount']))
+                        code.append('%sfor(size_t c=0; c < n; c++)\n' % t4)
+                        code.append('%s  {\n' % t4)
+                        t4 = tab*6
+                        code.append('%sconst %s& x = (*h)[c];\n' % \
+                                    (t4, block['className']))
+                else:
+                        code.append('%sconst %s& x = *h;\n' % \
+                                    (t4, block['className']))
+                if hasflags:
+                        code.append('%s%s word = 0;\n' % \
+                                    (t4, flagType(block)))
+
+                bit = 0
+                values = {}
+                for jj, (rtype, method, varname, bits, packed) in \
+                            enumerate(block['var']):
+                        if simpletype:
+                                call = "x"
+                        elif method[:1] == "=":
+                                # derived variable, computed from the
+                                # values stored for the current object
+                                call = cutExpression(method[1:], values)
+                        else:
+                                call = "x.%s" % method
+                        if bits > 0:
+                                call = "tnm_truncate((float)(%s), %d)" % \
+                                       (call, bits)
+                        # a failed call stores a default value so that
+                        # the variables of the block stay aligned object
+                        # by object
+                        if packed:
+                                stmt = 'if ( %s ) word |= 1ULL << %d;' % \
+                                       (call, bit)
+                                fail = ''
+                                bit += 1
+                        elif vectortype:
+                                stmt = 'b%d_%d.push_back( %s );' % \
+                                       (ii, jj, call)
+                                fail = 'b%d_%d.emplace_back();' % (ii, jj)
+                        else:
+                                stmt = 'b%d_%d = %s;' % (ii, jj, call)
+                                fail = 'b%d_%d = decltype(b%d_%d)();' % \
+                                       (ii, jj, ii, jj)
+                        code.append('%stry\n' % t4)
+                        code.append('%s  {\n' % t4)
+                        code.append('%s    %s\n' % (t4, stmt))
+                        code.append('%s  }\n' % t4)
+                        code.append('%scatch (...)\n' % t4)
+                        code.append('%s  {\n' % t4)
+                        if fail != '':
+                                code.append('%s    %s\n' % (t4, fail))
+                        code.append('%s    edm::LogWarning("FAILEDCALL")\n'%t4)
+                        code.append('%s      << "%s %s" << std::endl;\n' % \
+                                    (t4, block['blockName'],
+                                     method.replace('"', '\\"')))
+                        code.append('%s  }\n' % t4)
+
+                        # the values of the variables of the block that
+                        # a derived expression may use
+                        if not packed:
+                                name = block['branchnames'][jj]
+                                name = name[name.find(".")+1:]
+                                if vectortype:
+                                        values[name] = "b%d_%d.back()" % \
+                                                       (ii, jj)
+                                else:
+                                        values[name] = "b%d_%d" % (ii, jj)
+                if hasflags and vectortype:
+                        code.append('%sb%d_flags.push_back(word);\n' % \
+                                    (t4, ii))
+                elif hasflags:
+                        code.append('%sb%d_flags = word;\n' % (t4, ii))
+                if vectortype:
+                        code.append('%s  }\n' % (tab*4))
+                code.append('%s  }\n' % t2)
+                # warn once per product per input file
+                code.append('%selse if ( !missing[%d] )\n' % (t2, ii))
+                code.append('%s  {\n' % t2)
+                code.append('%s    missing[%d] = true;\n' % (t2, ii))
+                code.append('%s    edm::LogWarning("getByTokenFailure")\n'%t2)
+                code.append('%s      << "unable to get product %s '\
+                            'with label %s" << std::endl;\n' % \
+                            (t2, objectType(block), block['label']))
+                code.append('%s  }\n' % t2)
+                code.append('%s}\n\n' % tab)
+        code.append('''  tree->Fill();
+}
+
+void
+%(name)s::respondToOpenInputFile(const edm::FileBlock&)
+{
+  // report missing products afresh for each input file
+  missing.assign(missing.size(), false);
+}
+
+//define this as a plug-in
+DEFINE_FWK_MODULE(%(name)s);
+''' % names)
+        return "".join(code)
+
+def writeBuildFile(packages):
+        rec = []
+        for name in ["FWCore/Framework",
+                     "FWCore/PluginManager",
+                     "FWCore/ParameterSet",
+                     "FWCore/MessageLogger",
+                     "FWCore/ServiceRegistry",
+                     "CommonTools/UtilAlgos",
+                     "DataFormats/Common",
+                     "PhysicsTools/TheNtupleMaker"] + packages:
+                rec.append('<use   name="%s"/>\n' % name)
+        rec.append('<use   name="root"/>\n')
+        rec.append('<flags CXXFLAGS="-O2"/>\n')
+        rec.append('<library   file="%s.cc" name="%s">\n' % (NAME, NAME))
+        rec.append('  <flags EDM_PLUGIN="1"/>\n')
+        rec.append('</library>\n')
+        return "".join(rec)
+#------------------------------------------------------------------------------
+def main():
+        tnm    = loadModule(CFI_FILE)
+        blocks = decodeBuffers(tnm)
+        createBranchnames(blocks)
+        headers, packages = findHeaders(blocks)
+
+        if not os.path.exists(OUTDIR): os.makedirs(OUTDIR)
+
+        filename = "%s/%s.cc" % (OUTDIR, NAME)
+        print("writing %s" % filename)
+        open(filename, "w").write(writeCode(blocks, headers))
+
+        filename = "%s/BuildFile.xml" % OUTDIR
+        print("writing %s" % filename)
+        open(filename, "w").write(writeBuildFile(packages))
+
+        nvar = sum([len(b['var']) for b in blocks])
+        print("\n\t%d blocks, %d variables" % (len(blocks), nvar))
+        print('\tnow do\n\t  cd %s\n\t  scram b\n'\
+              '\tand replace "TheNtupleMaker" by "%s" in your cfg file\n' % \
+              (PKGDIR, NAME))
+#------------------------------------------------------------------------------
+main()
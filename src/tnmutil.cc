@@ -6,30 +6,134 @@
 #include <boost/python/type_id.hpp>
 #include <boost/algorithm/string.hpp>
 #include <string>
+#include <vector>
+#include <map>
+#include <algorithm>
+#include <cctype>
+#include <fstream>
+#include <sstream>
+#include <iostream>
 #include <stdlib.h>
+#include <stdio.h>
+#include <unistd.h>
+#include <dirent.h>
+#include <utime.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+
+#include "FWCore/MessageLogger/interface/MessageLogger.h"
+#include "TSystem.h"
+#include "TClass.h"
+#include "PhysicsTools/TheNtupleMaker/interface/tnmutil.h"
 //-----------------------------------------------------------------------------
-std::string tnm_write_code(std::string getter_classname,
-			   std::string getter_objectname,
-			   std::string method,
-			   std::string otype,
-			   std::string rtype,
-			   int maxcount,
-			   int count)
+namespace {
+  bool tnm_is_simpletype(std::string otype)
+  {
+    boost::regex getsimpletype("^(float|double|int|long|unsigned"
+			       "|size_t|short|bool|char|string|std::string)");
+    boost::smatch matchtype;
+    std::string otype_lower = otype;
+    boost::algorithm::to_lower(otype_lower);
+    return boost::regex_search(otype_lower, matchtype, getsimpletype);
+  }
+
+  // Split a compound method, e.g., jetRef()->pt(), at its first top-level
+  // "->" or "." into the prefix (jetRef()), the operator and the remainder
+  // (pt()). Return false if the method is not compound.
+  bool tnm_split_method(std::string method,
+			std::string& prefix,
+			std::string& op,
+			std::string& rest)
+  {
+    int depth = 0;
+    bool quoted = false;
+    for(size_t c=0; c < method.size(); c++)
+      {
+	char ch = method[c];
+	if ( ch == '"' ) quoted = !quoted;
+	if ( quoted ) continue;
+	if      ( ch == '(' || ch == '[' || ch == '<' ) depth++;
+	else if ( ch == ')' || ch == ']' ) depth--;
+	else if ( ch == '>' && (c == 0 || method[c-1] != '-') ) depth--;
+	if ( depth != 0 || c == 0 ) continue;
+
+	if ( ch == '.' )
+	  op = ".";
+	else if ( ch == '-' && c+1 < method.size() && method[c+1] == '>' )
+	  op = "->";
+	else
+	  continue;
+
+	prefix = method.substr(0, c);
+	rest   = method.substr(c + op.size());
+	return rest != "";
+      }
+    return false;
+  }
+
+  // Write the call of a single method within a fused getter. A failed
+  // call stores a default value so that the variables of the block stay
+  // aligned object by object.
+  std::string tnm_write_fused_call(std::string tab,
+				   int index,
+				   std::string methodstr,
+				   std::string getter_classname,
+				   std::string method)
+  {
+    char record[10000];
+    sprintf(record,
+	    "%stry\n"
+	    "%s  {\n"
+	    "%s    v%d->emplace_back( %s );\n"
+	    "%s  }\n"
+	    "%scatch (...)\n"
+	    "%s  {\n"
+	    "%s    v%d->emplace_back();\n"
+	    "%s    edm::LogWarning(\"FAILEDCALL\")\n"
+	    "%s      << \"%s %s\" << std::endl;\n"
+	    "%s  }\n",
+	    tab.c_str(),
+	    tab.c_str(),
+	    tab.c_str(), index, methodstr.c_str(),
+	    tab.c_str(),
+	    tab.c_str(),
+	    tab.c_str(),
+	    tab.c_str(), index,
+	    tab.c_str(),
+	    tab.c_str(), getter_classname.c_str(), method.c_str(),
+	    tab.c_str());
+    return std::string(record);
+  }
+
+  // getter library cache (disabled if directory is empty)
+  std::string cacheDir_("");
+  long        cacheSize_(0);
+
+  // registry of compiled getters, keyed by getter key
+  struct RegisteredGetter
+  {
+    std::string classname;
+    long unsigned int address;
+    long unsigned int function;
+  };
+  std::map<std::string, RegisteredGetter> registry_;
+};
+//-----------------------------------------------------------------------------
+// Write the struct for the getter of a single variable.
+//-----------------------------------------------------------------------------
+std::string tnm_write_getter_struct(std::string getter_classname,
+				    std::string method,
+				    std::string otype,
+				    std::string rtype,
+				    int maxcount)
 {
   // check if object is a simple type
-  boost::regex getsimpletype("^(float|double|int|long|unsigned"
-			     "|size_t|short|bool|char|string|std::string)");
-  boost::smatch matchtype;
-  std::string otype_lower = otype;
-  boost::algorithm::to_lower(otype_lower);
-  bool simpletype = boost::regex_search(otype_lower, 
-					matchtype, 
-					getsimpletype);
-  
+  bool simpletype = tnm_is_simpletype(otype);
+
   // check if object is a vector type or a singleton
   // TODO: make this more robust
   bool vectortype= maxcount > 1;
-  
+
   char record[10000];
   std::string methodstr;
   if ( vectortype )
@@ -39,7 +143,7 @@ std::string tnm_write_code(std::string getter_classname,
 	methodstr = ""; // there is no spoon!
       else
 	methodstr = std::string(".") + method;
-      
+
       sprintf(record,
 	      "struct %s\n"
 	      "{\n"
@@ -57,22 +161,16 @@ std::string tnm_write_code(std::string getter_classname,
 	      "      }\n"
 	      "    catch (...)\n"
 	      "      {\n"
-              "        edm::LogWarning(\"FAILEDCALL\")\n" 
+              "        edm::LogWarning(\"FAILEDCALL\")\n"
               "          << \"%s %s\" << std::endl;\n"
 	      "      }\n"
 	      "  }\n"
-	      "};\n"
-	      "%s %s;\n"
-	      "long unsigned int* addr%d = (long unsigned int*)%s;\n"
-	      "*addr%d = (long unsigned int)&%s;\n",
+	      "};\n",
 	      getter_classname.c_str(),
 	      otype.c_str(), otype.c_str(),
 	      rtype.c_str(), rtype.c_str(),
 	      maxcount,
-	      methodstr.c_str(), getter_classname.c_str(), method.c_str(),
-	      getter_classname.c_str(), getter_objectname.c_str(),
-	      count, "0x%lx",
-	      count, getter_objectname.c_str());
+	      methodstr.c_str(), getter_classname.c_str(), method.c_str());
     }
   else
     {
@@ -81,7 +179,7 @@ std::string tnm_write_code(std::string getter_classname,
 	methodstr = "*o"; // there is no spoon!
       else
 	methodstr = std::string("o->") + method;
-      
+
       sprintf(record,
 	      "struct %s\n"
 	      "{\n"
@@ -96,21 +194,842 @@ std::string tnm_write_code(std::string getter_classname,
 	      "      }\n"
 	      "    catch (...)\n"
 	      "      {\n"
-              "        edm::LogWarning(\"FAILEDCALL\")\n" 
+              "        edm::LogWarning(\"FAILEDCALL\")\n"
               "          << \"%s %s\" << std::endl;\n"
 	      "      }\n"
 	      "  }\n"
-	      "};\n"
-	      "%s %s;\n"
-	      "long unsigned int* addr%d = (long unsigned int*)%s;\n"
-	      "*addr%d = (long unsigned int)&%s;\n",
+	      "};\n",
 	      getter_classname.c_str(),
 	      otype.c_str(), otype.c_str(),
 	      rtype.c_str(), rtype.c_str(),
-	      methodstr.c_str(), getter_classname.c_str(), method.c_str(),
-	      getter_classname.c_str(), getter_objectname.c_str(),
-	      count, "0x%lx",
-	      count, getter_objectname.c_str());      
+	      methodstr.c_str(), getter_classname.c_str(), method.c_str());
+    }
+  return std::string(record);
+}
+
+//-----------------------------------------------------------------------------
+// Write code to create a getter instance and a plain function that calls
+// its get method.
+//-----------------------------------------------------------------------------
+std::string tnm_write_trampoline_code(std::string getter_classname,
+				      std::string getter_objectname)
+{
+  char record[2000];
+  sprintf(record,
+	  "%s %s;\n"
+	  "extern \"C\" void %s_get(const void* oaddr, const void* vaddr)\n"
+	  "{\n"
+	  "  %s.get(oaddr, vaddr);\n"
+	  "}\n",
+	  getter_classname.c_str(), getter_objectname.c_str(),
+	  getter_classname.c_str(),
+	  getter_objectname.c_str());
+  return std::string(record);
+}
+
+//-----------------------------------------------------------------------------
+// Write code to create a getter instance and a plain function that calls
+// its get method, and to return their addresses. The returned code is
+// to be passed through Form(code, &address, &function).
+//-----------------------------------------------------------------------------
+std::string tnm_write_instance_code(std::string getter_classname,
+				    std::string getter_objectname,
+				    std::string addrname,
+				    int count)
+{
+  char record[2000];
+  sprintf(record,
+	  "long unsigned int* %s%d = (long unsigned int*)%s;\n"
+	  "*%s%d = (long unsigned int)&%s;\n"
+	  "long unsigned int* f%s%d = (long unsigned int*)%s;\n"
+	  "*f%s%d = (long unsigned int)&%s_get;\n",
+	  addrname.c_str(), count, "0x%lx",
+	  addrname.c_str(), count, getter_objectname.c_str(),
+	  addrname.c_str(), count, "0x%lx",
+	  addrname.c_str(), count, getter_classname.c_str());
+  return tnm_write_trampoline_code(getter_classname, getter_objectname)
+    + std::string(record);
+}
+
+//-----------------------------------------------------------------------------
+std::string tnm_write_code(std::string getter_classname,
+			   std::string getter_objectname,
+			   std::string method,
+			   std::string otype,
+			   std::string rtype,
+			   int maxcount,
+			   int count)
+{
+  return tnm_write_getter_struct(getter_classname,
+				 method,
+				 otype,
+				 rtype,
+				 maxcount) +
+    tnm_write_instance_code(getter_classname,
+			    getter_objectname,
+			    "addr",
+			    count);
+}
+
+//-----------------------------------------------------------------------------
+// Write a single "fused" getter for all the variables of a buffer. The
+// fused getter walks the collection once per event and, for each object,
+// calls every method and fills the associated buffers. The get method
+// of the fused getter takes the address of the EDM object and the address
+// of an array of addresses of the buffers (std::vector<rtype>) to be filled.
+//-----------------------------------------------------------------------------
+std::string tnm_write_fused_struct(std::string getter_classname,
+				   std::vector<std::string>& methods,
+				   std::string otype,
+				   std::vector<std::string>& rtypes,
+				   int maxcount,
+				   std::string cut)
+{
+  bool simpletype = tnm_is_simpletype(otype);
+  bool vectortype = maxcount > 1;
+
+  char record[10000];
+  std::string code("");
+
+  // header of get method
+  sprintf(record,
+	  "struct %s\n"
+	  "{\n"
+	  "  void get(const void* oaddr, const void* vaddr)\n"
+	  "  {\n"
+	  "    void* const* v = (void* const*)vaddr;\n",
+	  getter_classname.c_str());
+  code += std::string(record);
+
+  if ( vectortype )
+    sprintf(record,
+	    "    const std::vector<%s>* o = "
+	    "(const std::vector<%s>*)oaddr;\n",
+	    otype.c_str(), otype.c_str());
+  else
+    sprintf(record,
+	    "    const %s* o = (const %s*)oaddr;\n",
+	    otype.c_str(), otype.c_str());
+  code += std::string(record);
+
+  // buffers to be filled
+  for(size_t i=0; i < methods.size(); i++)
+    {
+      sprintf(record,
+	      "    std::vector<%s>* v%d = (std::vector<%s>*)v[%d];\n"
+	      "    v%d->clear();\n",
+	      rtypes[i].c_str(), (int)i, rtypes[i].c_str(), (int)i,
+	      (int)i);
+      code += std::string(record);
+    }
+
+  // loop over objects, or just point to the singleton. if there is a
+  // cut, loop until maxcount objects have passed it. an object whose cut
+  // cannot be evaluated is rejected.
+  std::string tab("    ");
+  if ( vectortype && cut != "" )
+    {
+      sprintf(record,
+	      "    size_t n = 0;\n"
+	      "    for(size_t c = 0; c < o->size() && n < (size_t)%d; c++)\n"
+	      "      {\n"
+	      "        const %s& x = (*o)[c];\n"
+	      "        bool selected = false;\n"
+	      "        try\n"
+	      "          {\n"
+	      "            selected = %s;\n"
+	      "          }\n"
+	      "        catch (...)\n"
+	      "          {\n"
+	      "            edm::LogWarning(\"FAILEDCALL\")\n"
+	      "              << \"%s cut\" << std::endl;\n"
+	      "          }\n"
+	      "        if ( ! selected ) continue;\n"
+	      "        n++;\n",
+	      maxcount, otype.c_str(), tnm_cut_expression(cut).c_str(),
+	      getter_classname.c_str());
+      tab = std::string("        ");
+    }
+  else if ( vectortype )
+    {
+      sprintf(record,
+	      "    size_t n = std::min(o->size(), (size_t)%d);\n"
+	      "    for(size_t c = 0; c < n; c++)\n"
+	      "      {\n"
+	      "        const %s& x = (*o)[c];\n",
+	      maxcount, otype.c_str());
+      tab = std::string("        ");
+    }
+  else
+    sprintf(record,
+	    "    const %s& x = *o;\n",
+	    otype.c_str());
+  code += std::string(record);
+
+  // group compound methods by their common prefix so that the prefix,
+  // e.g., the dereferencing of jetRef() in jetRef()->pt() and
+  // jetRef()->eta(), is evaluated once per object.
+  std::vector<std::string> prefixes;
+  std::vector<std::vector<int> > groups;
+  std::vector<std::string> rests(methods.size());
+  std::vector<int> ungrouped;
+  std::vector<int> derived;
+  for(size_t i=0; i < methods.size(); i++)
+    {
+      // derived variables (see tnm_derived_expression) are computed last
+      if ( methods[i].substr(0, 1) == "=" )
+	{
+	  derived.push_back(i);
+	  continue;
+	}
+      std::string prefix, op, rest;
+      if ( simpletype || !tnm_split_method(methods[i], prefix, op, rest) )
+	{
+	  ungrouped.push_back(i);
+	  continue;
+	}
+      // for "->" the target is bound to a reference, so it is accessed
+      // with "."
+      prefix = op == "->" ? std::string("*x.") + prefix :
+	std::string("x.") + prefix;
+      rests[i] = rest;
+
+      size_t g = std::find(prefixes.begin(), prefixes.end(), prefix)
+	- prefixes.begin();
+      if ( g == prefixes.size() )
+	{
+	  prefixes.push_back(prefix);
+	  groups.push_back(std::vector<int>());
+	}
+      groups[g].push_back(i);
+    }
+
+  // a prefix used by a single method is not worth a group
+  for(size_t g=0; g < groups.size(); g++)
+    if ( groups[g].size() == 1 ) ungrouped.push_back(groups[g][0]);
+  std::sort(ungrouped.begin(), ungrouped.end());
+
+  // call methods, one at a time, so that a failed call affects only
+  // the associated variable
+  for(size_t j=0; j < ungrouped.size(); j++)
+    {
+      int i = ungrouped[j];
+      std::string methodstr;
+      if ( simpletype )
+	methodstr = "x"; // there is no spoon!
+      else
+	methodstr = std::string("x.") + methods[i];
+      code += tnm_write_fused_call(tab, i, methodstr,
+				   getter_classname, methods[i]);
+    }
+
+  // evaluate each common prefix once, then call the remainder of each
+  // method of the group. If the prefix fails, so would every method of
+  // the group, so each of them gets a default value.
+  std::string tab2 = tab + std::string("    ");
+  for(size_t g=0; g < groups.size(); g++)
+    {
+      if ( groups[g].size() < 2 ) continue;
+      sprintf(record,
+	      "%stry\n"
+	      "%s  {\n"
+	      "%s    const auto& p%d = %s;\n",
+	      tab.c_str(),
+	      tab.c_str(),
+	      tab.c_str(), (int)g, prefixes[g].c_str());
+      code += std::string(record);
+
+      for(size_t j=0; j < groups[g].size(); j++)
+	{
+	  int i = groups[g][j];
+	  sprintf(record, "p%d.%s", (int)g, rests[i].c_str());
+	  code += tnm_write_fused_call(tab2, i, std::string(record),
+				       getter_classname, methods[i]);
+	}
+
+      sprintf(record,
+	      "%s  }\n"
+	      "%scatch (...)\n"
+	      "%s  {\n",
+	      tab.c_str(),
+	      tab.c_str(),
+	      tab.c_str());
+      code += std::string(record);
+
+      for(size_t j=0; j < groups[g].size(); j++)
+	{
+	  sprintf(record,
+		  "%s    v%d->emplace_back();\n",
+		  tab.c_str(), groups[g][j]);
+	  code += std::string(record);
+	}
+
+      sprintf(record,
+	      "%s    edm::LogWarning(\"FAILEDCALL\")\n"
+	      "%s      << \"%s %s\" << std::endl;\n"
+	      "%s  }\n",
+	      tab.c_str(),
+	      tab.c_str(), getter_classname.c_str(),
+	      prefixes[g].substr(prefixes[g][0] == '*' ? 3 : 2).c_str(),
+	      tab.c_str());
+      code += std::string(record);
+    }
+
+  // compute derived variables from the values just stored for the 
+  // current object. Every variable stores a value for every object, so
+  // the values are always there.
+  for(size_t j=0; j < derived.size(); j++)
+    {
+      int i = derived[j];
+      code += tnm_write_fused_call(tab, i, methods[i].substr(1), 
+				   getter_classname,
+				   boost::replace_all_copy(methods[i], 
+							   "\"", "\\\""));
+    }
+  if ( vectortype ) code += std::string("      }\n");
+
+  code += std::string("  }\n"
+		      "};\n");
+  return code;
+}
+
+//-----------------------------------------------------------------------------
+std::string tnm_write_fused_code(std::string getter_classname,
+				 std::string getter_objectname,
+				 std::vector<std::string>& methods,
+				 std::string otype,
+				 std::vector<std::string>& rtypes,
+				 int maxcount,
+				 int count,
+				 std::string cut)
+{
+  return tnm_write_fused_struct(getter_classname,
+				methods,
+				otype,
+				rtypes,
+				maxcount,
+				cut) +
+    tnm_write_instance_code(getter_classname,
+			    getter_objectname,
+			    "baddr",
+			    count);
+}
+
+//-----------------------------------------------------------------------------
+// Getter library cache
+//
+// The code of each getter is compiled once, with optimization, into a
+// shared library that is stored in a local cache directory and re-used by
+// later jobs. The library is named after a hash of its source code, the
+// header that declares the object type, the CMSSW version and the SCRAM
+// architecture, so that a library is rebuilt whenever the code it would be
+// built from changes. Moreover, the libraries are stored in the directory
+//   <cache>/<CMSSW_VERSION>/<SCRAM_ARCH>
+// so that libraries built with a different release are never loaded. When
+// the total size of the libraries exceeds the maximum cache size, the least
+// recently used libraries are deleted.
+//-----------------------------------------------------------------------------
+std::string tnm_hash(std::string str)
+{
+  // 64-bit FNV-1a hash
+  unsigned long long h = 14695981039346656037ULL;
+  for(size_t c=0; c < str.size(); c++)
+    {
+      h ^= (unsigned char)str[c];
+      h *= 1099511628211ULL;
     }
+  char record[80];
+  sprintf(record, "%016llx", h);
   return std::string(record);
 }
+
+/// Return key that identifies the getter of a single variable.
+std::string tnm_getter_key(std::string otype,
+			   std::string rtype,
+			   std::string method,
+			   int maxcount)
+{
+  char record[80];
+  sprintf(record, "|%d", maxcount);
+  return otype + "|" + rtype + "|" + method + std::string(record);
+}
+
+/// Return key that identifies a fused getter.
+std::string tnm_fused_getter_key(std::string otype,
+				 std::vector<std::string>& rtypes,
+				 std::vector<std::string>& methods,
+				 int maxcount,
+				 std::string cut)
+{
+  char record[80];
+  sprintf(record, "|%d", maxcount);
+  std::string key = otype + std::string(record);
+  for(size_t c=0; c < methods.size(); c++)
+    key += "|" + rtypes[c] + "|" + methods[c];
+  if ( cut != "" ) key += "|cut|" + cut;
+  return key;
+}
+
+namespace {
+  std::string tnm_getenv(std::string name)
+  {
+    const char* value = getenv(name.c_str());
+    if ( value ) return std::string(value);
+    return std::string("unknown");
+  }
+
+  struct CacheEntry
+  {
+    std::string stem;
+    long   size;
+    time_t mtime;
+    bool operator<(const CacheEntry& o) const { return mtime < o.mtime; }
+  };
+
+  // Delete least recently used libraries until the size of the cache
+  // is below the maximum size.
+  void tnm_evict_getters()
+  {
+    DIR* dir = opendir(cacheDir_.c_str());
+    if ( !dir ) return;
+
+    std::vector<CacheEntry> entries;
+    long total = 0;
+    struct dirent* entry;
+    while ( (entry = readdir(dir)) != 0 )
+      {
+	std::string name(entry->d_name);
+	if ( name.size() < 6 ) continue;
+	if ( name.substr(name.size()-6) != "_cc.so" ) continue;
+
+	struct stat info;
+	std::string path = cacheDir_ + "/" + name;
+	if ( stat(path.c_str(), &info) != 0 ) continue;
+
+	CacheEntry e;
+	e.stem  = cacheDir_ + "/" + name.substr(0, name.size()-6);
+	e.size  = (long)info.st_size;
+	e.mtime = info.st_mtime;
+	entries.push_back(e);
+	total += e.size;
+      }
+    closedir(dir);
+
+    if ( total <= cacheSize_ ) return;
+
+    // oldest first
+    std::sort(entries.begin(), entries.end());
+    for(size_t c=0; c < entries.size(); c++)
+      {
+	if ( total <= cacheSize_ ) break;
+	unlink((entries[c].stem + "_cc.so").c_str());
+	unlink((entries[c].stem + "_cc_ACLiC_dict_rdict.pcm").c_str());
+	unlink((entries[c].stem + "_cc.d").c_str());
+	unlink((entries[c].stem + ".cc").c_str());
+	total -= entries[c].size;
+      }
+  }
+
+  // create directory and its parents, if needed
+  bool tnm_mkdir(std::string path)
+  {
+    std::string dir("");
+    std::vector<std::string> fields;
+    boost::algorithm::split(fields, path, boost::is_any_of("/"));
+    for(size_t c=0; c < fields.size(); c++)
+      {
+	if ( c > 0 ) dir += "/";
+	dir += fields[c];
+	if ( dir == "" || dir == "/" ) continue;
+	mkdir(dir.c_str(), 0755);
+      }
+    struct stat info;
+    return stat(path.c_str(), &info) == 0 && S_ISDIR(info.st_mode);
+  }
+
+  // delete a staging directory together with whatever files ACLiC left
+  // in it
+  void tnm_rmtmpdir(std::string path)
+  {
+    DIR* dir = opendir(path.c_str());
+    if ( dir )
+      {
+	struct dirent* entry;
+	while ( (entry = readdir(dir)) != 0 )
+	  {
+	    std::string name(entry->d_name);
+	    if ( name == "." || name == ".." ) continue;
+	    unlink((path + "/" + name).c_str());
+	  }
+	closedir(dir);
+      }
+    rmdir(path.c_str());
+  }
+
+  // return the contents of a header, looked for first in the local area
+  // then in the release, or "" if it cannot be found
+  std::string tnm_read_header(std::string header)
+  {
+    std::vector<std::string> dirs;
+    dirs.push_back(tnm_getenv("CMSSW_BASE") + "/src/");
+    dirs.push_back(tnm_getenv("CMSSW_RELEASE_BASE") + "/src/");
+    for(size_t c=0; c < dirs.size(); c++)
+      {
+	std::ifstream fin((dirs[c] + header).c_str());
+	if ( ! fin.good() ) continue;
+	std::ostringstream os;
+	os << fin.rdbuf();
+	return os.str();
+      }
+    return std::string("");
+  }
+};
+
+/// Enable the getter library cache. An empty directory disables it.
+void tnm_set_getter_cache(std::string dirname, int maxsize)
+{
+  cacheDir_  = "";
+  cacheSize_ = 0;
+  if ( dirname == "" ) return;
+
+  std::string dir = dirname + "/"
+    + tnm_getenv("CMSSW_VERSION") + "/"
+    + tnm_getenv("SCRAM_ARCH");
+  if ( ! tnm_mkdir(dir) )
+    {
+      edm::LogWarning("GetterCacheFailure")
+	<< "unable to create getter cache " << dir
+	<< "; getters will be compiled with the JIT compiler" << std::endl;
+      return;
+    }
+  cacheDir_  = dir;
+  cacheSize_ = (long)maxsize * 1024 * 1024;
+
+  // make sure the compiler can find the CMSSW headers
+  std::string base = tnm_getenv("CMSSW_BASE");
+  std::string release = tnm_getenv("CMSSW_RELEASE_BASE");
+  gSystem->AddIncludePath(("-I" + base + "/src").c_str());
+  gSystem->AddIncludePath(("-I" + release + "/src").c_str());
+
+  tnm_evict_getters();
+}
+
+/// Return the getter library cache directory ("" if disabled).
+std::string tnm_getter_cache() { return cacheDir_; }
+
+/// Return name of getter class given the getter key.
+std::string tnm_getter_classname(std::string key)
+{
+  return std::string("TNMGetter_") + tnm_hash(key);
+}
+
+/**
+    Load the shared library for the given getter, compiling it first if
+    it is not already in the cache, and return the address of the getter
+    instance and of the function that calls its get method. Return false
+    if the cache is disabled or the library cannot be built or loaded.
+    @param getter_classname - name of getter class (see tnm_getter_classname)
+    @param structcode       - code of getter struct
+    @param otype            - object type
+    @param address          - address of getter instance
+    @param function         - address of function that calls get method
+*/
+bool tnm_load_cached_getter(std::string getter_classname,
+			    std::string structcode,
+			    std::string otype,
+			    long unsigned int& address,
+			    long unsigned int& function)
+{
+  if ( cacheDir_ == "" ) return false;
+
+  std::string header("");
+  TClass* oclass = tnm_is_simpletype(otype)
+    ? 0 : TClass::GetClass(otype.c_str());
+  if ( oclass && oclass->GetDeclFileName() )
+    header = std::string(oclass->GetDeclFileName());
+
+  std::ostringstream os;
+  os << "#include <vector>" << std::endl;
+  os << "#include <string>" << std::endl;
+  os << "#include <algorithm>" << std::endl;
+  os << "#include \"FWCore/MessageLogger/interface/MessageLogger.h\""
+     << std::endl;
+  os << "#include \"PhysicsTools/TheNtupleMaker/interface/kit.h\""
+     << std::endl;
+  if ( header != "" )
+    os << "#include \"" << header << "\"" << std::endl;
+  os << "using namespace std;" << std::endl;
+  os << structcode;
+  os << getter_classname << " " << getter_classname << "_instance_;"
+     << std::endl;
+  os << "extern \"C\" void* " << getter_classname << "_instance()"
+     << std::endl
+     << "{" << std::endl
+     << "  return &" << getter_classname << "_instance_;" << std::endl
+     << "}" << std::endl;
+  os << "extern \"C\" void " << getter_classname
+     << "_get(const void* oaddr, const void* vaddr)" << std::endl
+     << "{" << std::endl
+     << "  " << getter_classname << "_instance_.get(oaddr, vaddr);"
+     << std::endl
+     << "}" << std::endl;
+  std::string code = os.str();
+
+  // name the library after what it is built from
+  std::string libstem = std::string("TNMGetter_")
+    + tnm_hash(tnm_getenv("CMSSW_VERSION") + "|"
+	       + tnm_getenv("SCRAM_ARCH") + "|"
+	       + tnm_read_header(header) + "|"
+	       + code);
+  std::string stem    = cacheDir_ + "/" + libstem;
+  std::string libname = stem + "_cc.so";
+
+  struct stat info;
+  if ( stat(libname.c_str(), &info) != 0 )
+    {
+      // Not in cache, so build library in a private directory and move
+      // it into the cache to avoid clashes with concurrent jobs.
+      char record[80];
+      sprintf(record, "/tmp%d", (int)getpid());
+      std::string tmpdir = cacheDir_ + std::string(record);
+      mkdir(tmpdir.c_str(), 0755);
+      std::string tmpstem = tmpdir + "/" + libstem;
+
+      std::ofstream fout((tmpstem + ".cc").c_str());
+      fout << code;
+      fout.close();
+
+      // compile with optimization, keep library, but do not load it
+      if ( gSystem->CompileMacro((tmpstem + ".cc").c_str(), "kOc") != 1 )
+	{
+	  edm::LogWarning("GetterCacheFailure")
+	    << "unable to build " << tmpstem << ".cc"
+	    << "; getter will be compiled with the JIT compiler" << std::endl;
+	  tnm_rmtmpdir(tmpdir);
+	  return false;
+	}
+      rename((tmpstem + ".cc").c_str(), (stem + ".cc").c_str());
+      rename((tmpstem + "_cc_ACLiC_dict_rdict.pcm").c_str(),
+	     (stem + "_cc_ACLiC_dict_rdict.pcm").c_str());
+      rename((tmpstem + "_cc.so").c_str(), libname.c_str());
+      tnm_rmtmpdir(tmpdir);
+    }
+  else
+    // mark library as recently used
+    utime(libname.c_str(), 0);
+
+  if ( gSystem->Load(libname.c_str()) < 0 )
+    {
+      edm::LogWarning("GetterCacheFailure")
+	<< "unable to load " << libname
+	<< "; getter will be compiled with the JIT compiler" << std::endl;
+      return false;
+    }
+
+  typedef void* (*Instance)();
+  Instance instance =
+    (Instance)gSystem->DynFindSymbol(libname.c_str(),
+				     (getter_classname + "_instance").c_str());
+  function =
+    (long unsigned int)gSystem->DynFindSymbol(libname.c_str(),
+					      (getter_classname
+					       + "_get").c_str());
+  if ( !instance || !function ) return false;
+
+  address = (long unsigned int)instance();
+  return true;
+}
+
+//-----------------------------------------------------------------------------
+// Getter registry
+//
+// Getters are stateless, so getters with the same key, which arise when
+// the same class appears in several blocks or under several labels, are
+// compiled once and the instance shared.
+//-----------------------------------------------------------------------------
+/**
+    Return true if a getter with the given key has been registered, in which
+    case return the name of its class, the address of its instance and the
+    address of the function that calls its get method.
+*/
+bool tnm_find_getter(std::string key,
+		     std::string& getter_classname,
+		     long unsigned int& address,
+		     long unsigned int& function)
+{
+  std::map<std::string, RegisteredGetter>::iterator it = registry_.find(key);
+  if ( it == registry_.end() ) return false;
+  getter_classname = it->second.classname;
+  address  = it->second.address;
+  function = it->second.function;
+  return true;
+}
+
+/// Register a compiled getter under the given key.
+void tnm_register_getter(std::string key,
+			 std::string getter_classname,
+			 long unsigned int address,
+			 long unsigned int function)
+{
+  if ( address == 0 ) return;
+  RegisteredGetter g;
+  g.classname = getter_classname;
+  g.address   = address;
+  g.function  = function;
+  registry_[key] = g;
+}
+
+//-----------------------------------------------------------------------------
+/// Return name of the branch into which the flags of a block are packed, 
+/// given the name of the branch of one of its variables.
+std::string tnm_flag_branchname(std::string branchname)
+{
+  return branchname.substr(0, branchname.find('.')) + ".flags";
+}
+
+//-----------------------------------------------------------------------------
+/// Return name of an array branch (array layout), i.e., the branch name 
+/// with "." replaced by "_", so that it is a valid leaf name.
+std::string tnm_array_branchname(std::string branchname)
+{
+  std::replace(branchname.begin(), branchname.end(), '.', '_');
+  return branchname;
+}
+
+/// Return name of the counter branch of a block (array layout), given the 
+/// name of the branch of one of its variables.
+std::string tnm_counter_branchname(std::string branchname)
+{
+  return std::string("n") + branchname.substr(0, branchname.find('.'));
+}
+
+/// Return leaflist type code of a simple type or "" if there is none.
+std::string tnm_leaf_type(std::string rtype)
+{
+  static std::map<std::string, std::string> leaftype;
+  if ( leaftype.size() == 0 )
+    {
+      leaftype["char"]           = "B";
+      leaftype["unsigned char"]  = "b";
+      leaftype["short"]          = "S";
+      leaftype["unsigned short"] = "s";
+      leaftype["int"]            = "I";
+      leaftype["unsigned int"]   = "i";
+      leaftype["long"]           = "L";
+      leaftype["unsigned long"]  = "l";
+      leaftype["long long"]      = "L";
+      leaftype["unsigned long long"] = "l";
+      leaftype["float"]          = "F";
+      leaftype["double"]         = "D";
+      leaftype["bool"]           = "O";
+    }
+  std::map<std::string, std::string>::iterator it = leaftype.find(rtype);
+  if ( it == leaftype.end() ) return std::string("");
+  return it->second;
+}
+
+//-----------------------------------------------------------------------------
+namespace {
+  // Prefix every unqualified call, other than a call to a math function,
+  // with "x.". If names is given, replace each of the names that is not a
+  // call by vK->back(), where K is the position of the name in names.
+  std::string tnm_translate(std::string cut, 
+			    const std::vector<std::string>* names)
+  {
+    static const char* functions[] = {"abs", "fabs", "sqrt", "pow", "exp", 
+				      "log", "log10", "sin", "cos", "tan", 
+				      "asin", "acos", "atan", "atan2", 
+				      "sinh", "cosh", "tanh", "hypot", 
+				      "min", "max", "floor", "ceil", 
+				      "round", 0};
+    std::string expr("");
+    size_t c = 0;
+    while ( c < cut.size() )
+      {
+	char ch = cut[c];
+
+	// copy string literals and numbers as is
+	if ( ch == '"' )
+	  {
+	    size_t end = cut.find('"', c+1);
+	    if ( end == std::string::npos ) end = cut.size()-1;
+	    expr += cut.substr(c, end-c+1);
+	    c = end+1;
+	    continue;
+	  }
+	if ( isdigit(ch) )
+	  {
+	    size_t end = c;
+	    while ( end < cut.size() && 
+		    (isalnum(cut[end]) || cut[end] == '.') )
+	      end++;
+	    expr += cut.substr(c, end-c);
+	    c = end;
+	    continue;
+	  }
+	if ( ! (isalpha(ch) || ch == '_') )
+	  {
+	    expr += ch;
+	    c++;
+	    continue;
+	  }
+
+	// identifier
+	size_t end = c;
+	while ( end < cut.size() && (isalnum(cut[end]) || cut[end] == '_') )
+	  end++;
+	std::string name = cut.substr(c, end-c);
+
+	// is it an unqualified call?
+	bool qualified = (c > 0 && cut[c-1] == '.') || 
+	  (c > 1 && cut[c-1] == '>' && cut[c-2] == '-') ||
+	  (c > 1 && cut[c-1] == ':' && cut[c-2] == ':');
+	size_t next = end;
+	while ( next < cut.size() && cut[next] == ' ' ) next++;
+	bool call = next < cut.size() && cut[next] == '(';
+	bool scope = next+1 < cut.size() && 
+	  cut[next] == ':' && cut[next+1] == ':';
+	bool function = false;
+	for(int i=0; functions[i] != 0; i++)
+	  if ( name == functions[i] ) function = true;
+
+	int index = -1;
+	if ( names && ! call && ! qualified && ! scope )
+	  for(size_t i=0; i < names->size(); i++)
+	    if ( (*names)[i] == name ) index = i;
+
+	if ( index > -1 )
+	  {
+	    char record[80];
+	    sprintf(record, "v%d->back()", index);
+	    expr += std::string(record);
+	  }
+	else
+	  {
+	    if ( call && ! qualified && ! function ) expr += "x.";
+	    expr += name;
+	  }
+	c = end;
+      }
+    return expr;
+  }
+};
+
+/// Translate a cut, e.g., pt() > 20 && abs(eta()) < 2.5, into an expression
+/// in the object x, e.g., x.pt() > 20 && abs(x.eta()) < 2.5, by prefixing 
+/// every unqualified call, other than a call to a math function, with "x.".
+std::string tnm_cut_expression(std::string cut)
+{
+  return tnm_translate(cut, 0);
+}
+
+/// Translate a derived expression, e.g., pt*cosh(eta()), into code for a
+/// fused getter. Calls are translated as for a cut, and the names of the 
+/// variables of the block that precede the derived variable, given in 
+/// names, are replaced by the values just stored for the current object,
+/// e.g., v0->back()*cosh(x.eta()).
+std::string tnm_derived_expression(std::string expr,
+				   std::vector<std::string>& names)
+{
+  return tnm_translate(expr, &names);
+}
@@ -0,0 +1,58 @@
+//-----------------------------------------------------------------------------
+// Test the object-level result cache of HelperFor: the results of two
+// objects cached in the same event must not be confused, even when the
+// object index is not given.
+//-----------------------------------------------------------------------------
+#include <cassert>
+#include <iostream>
+#include "PhysicsTools/TheNtupleMaker/interface/HelperFor.h"
+//-----------------------------------------------------------------------------
+struct Thing
+{
+  Thing(double v) : value(v) {}
+  double value;
+};
+
+struct ThingHelper : public HelperFor<Thing>
+{
+  ThingHelper() : HelperFor<Thing>(), ncalls(0) {}
+
+  void analyzeObject()
+  {
+    ncalls++;
+    setResult("twice", 2 * object->value);
+  }
+
+  double twice()
+  {
+    analyzeObjectOnce();
+    return result("twice");
+  }
+
+  int ncalls;
+};
+
+int main()
+{
+  Thing a(1), b(5);
+  ThingHelper helper;
+
+  // two passes over two objects, without object indices
+  for(int pass=0; pass < 2; pass++)
+    {
+      helper.cacheObject(a);
+      assert(helper.twice() == 2);
+      helper.cacheObject(b);
+      assert(helper.twice() == 10);
+    }
+  assert(helper.ncalls == 2);
+
+  // the results are forgotten at the end of the event
+  helper.flushEvent();
+  helper.cacheObject(b);
+  assert(helper.twice() == 10);
+  assert(helper.ncalls == 3);
+
+  std::cout << "testHelperFor: OK" << std::endl;
+  return 0;
+}